@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+
+"""run_benchmarks.py  :  Measure how the operations of BioMongo tools scale on synthetic EGA collections """
+
+__author__ = "Marta Huertas"
+__version__ = "0.1"
+__maintainer__ = "Aldar Cabrelles"
+__email__ = "aldar.cabrelles@crg.eu"
+__status__ = "development"
+
+# Import Packages
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+import pandas as pd
+from bson.objectid import ObjectId
+from pymongo import MongoClient, monitoring
+
+# The operations are imported from the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from source import insert, update_value, restore_value, new_field, rename_field, remove_field, scan_functions
+
+results_directory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# ----------
+# Synthetic EGA documents
+# ----------
+def fileDocument(i):
+    return {
+        "stable_id": f"EGAF{i:011d}",
+        "filename": f"sample_{i}.bam",
+        "filetype": random.choice(["bam", "cram", "vcf", "fastq"]),
+        "checksum": f"{random.getrandbits(128):032x}",
+        "size": random.randint(10**6, 10**11),
+        "sample_ids": [f"EGAN{random.randint(0, 10**6):011d}" for _ in range(random.randint(1, 3))]
+    }
+
+def sampleDocument(i):
+    return {
+        "stable_id": f"EGAN{i:011d}",
+        "biological_sex": random.choice(["female", "male", "unknown"]),
+        "phenotype": random.sample(["healthy", "cancer", "diabetes", "asthma", "obesity"], random.randint(1, 3)),
+        "organism_part": {"name": random.choice(["blood", "liver", "skin"]), "ontology": "UBERON"},
+        "cell_line": None
+    }
+
+def datasetDocument(i):
+    return {
+        "stable_id": f"EGAD{i:011d}",
+        "title": f"Dataset {i}",
+        "description": "Synthetic dataset generated for benchmarking. " * 5,
+        "policy_id": f"EGAP{random.randint(0, 1000):011d}",
+        "files": [f"EGAF{random.randint(0, 10**6):011d}" for _ in range(20)]
+    }
+
+def studyDocument(i):
+    return {
+        "stable_id": f"EGAS{i:011d}",
+        "title": f"Study {i}",
+        "study_type": random.choice(["Cancer Genomics", "Whole Genome Sequencing", "Transcriptome Analysis"]),
+        "publications": [{"pubmed_id": random.randint(10**6, 10**8)} for _ in range(random.randint(0, 3))]
+    }
+
+document_generators = {"file": fileDocument, "sample": sampleDocument, "dataset": datasetDocument, "study": studyDocument}
+
+def loadCollection(db, collection_name, documents, log_depth, log_backend):
+    """
+    Fill a collection with synthetic documents whose status field was changed log_depth times by previous processes.
+    """
+    start_date = datetime.now() - timedelta(days=log_depth + 1)
+    process_ids = [db["log_details"].insert_one({
+        "name": "benchmark", "operation": "update_all", "collection": collection_name, "method": "benchmark",
+        "date": (start_date + timedelta(days=depth)).strftime('%Y-%m-%dT%H:%M:%S+00:00')
+    }).inserted_id for depth in range(log_depth + 1)]
+
+    def history(depth):
+        if depth == 0:
+            return {"log_id": str(process_ids[0]), "operation": "insert"}
+        return {"log_id": str(process_ids[depth]), "operation": "update_all", "modified_field": "status",
+                "changed_values": {"added": [f"status_{depth}"], "removed": [f"status_{depth - 1}"]}}
+
+    generator = document_generators[collection_name]
+    for start in range(0, documents, 10000):
+        chunk = [generator(i) for i in range(start, min(start + 10000, documents))]
+        for document in chunk:
+            document["_id"] = ObjectId()
+            document["status"] = f"status_{log_depth}"
+            if log_backend == 'embedded':
+                document["log"] = [history(depth) for depth in reversed(range(log_depth + 1))]
+        db[collection_name].insert_many(chunk)
+
+        if log_backend == 'journal':
+            db["log_entries"].insert_many([
+                {"collection": collection_name, "document_id": document["_id"], **history(depth), "date": start_date + timedelta(days=depth)}
+                for document in chunk for depth in range(log_depth + 1)
+            ])
+
+# ----------
+# Measurements
+# ----------
+class RoundTripCounter(monitoring.CommandListener):
+    """
+    Count the commands sent to MongoDB, each of them is a round trip.
+    """
+    def __init__(self):
+        self.commands = 0
+
+    def started(self, event):
+        self.commands += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+@contextlib.contextmanager
+def redirectStdin(stream):
+    """
+    Read the input of the operations from a stream.
+    """
+    stdin, sys.stdin = sys.stdin, stream
+    try:
+        yield
+    finally:
+        sys.stdin = stdin
+
+def measure(operation, collection_name, documents, counter, function, *arguments, check=None):
+    """
+    Run an operation with its output silenced and return its duration, throughput, round trips and peak memory.
+    check is called after the operation and returns what's wrong with its effect on the collection, if anything: an operation that doesn't do its work is a failure, not a result.
+    """
+    commands_before = counter.commands if counter else 0
+    tracemalloc.start()
+    start = time.perf_counter()
+    error = None
+    try:
+        # Confirmations (e.g. remove_field) are answered with yes
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), redirectStdin(io.StringIO("yes\n")):
+            function(*arguments)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    seconds = time.perf_counter() - start
+    if not error and check:
+        problem = check()
+        error = f"Wrong result: {problem}" if problem else None
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {
+        "operation": operation,
+        "collection": collection_name,
+        "documents": documents,
+        "seconds": round(seconds, 4),
+        "documents_per_second": round(documents / seconds, 1) if seconds and not error else None,
+        "round_trips": counter.commands - commands_before if counter else None,
+        "peak_memory_mb": round(peak_memory / 2**20, 2),
+        "error": error
+    }
+    print(f"{operation:>16} {collection_name:>8}: " + (f"{result['seconds']:.3f} s, {result['documents_per_second']} documents/s, {result['round_trips'] if counter else 'n/a'} round trips, {result['peak_memory_mb']} MB" if not error else f"failed ({error})"))
+    return result
+
+def unsupported(operation, collection_name, documents, reason):
+    """
+    Record an operation that can't be measured on the target instead of timing it.
+    """
+    print(f"{operation:>16} {collection_name:>8}: not measured ({reason})")
+    return {"operation": operation, "collection": collection_name, "documents": documents, "seconds": None, "documents_per_second": None,
+            "round_trips": None, "peak_memory_mb": None, "error": f"Unsupported: {reason}"}
+
+def countProblem(db, collection_name, query, expected, description):
+    """
+    Check that expected documents of the collection match the query.
+    """
+    found = db[collection_name].count_documents(query)
+    return f"{found} of {expected} documents {description}" if found != expected else None
+
+def logProblem(db, collection_name, operation, backend, expected):
+    """
+    Check that the last process of the operation logged expected documents, with its log_id as a string (not an unevaluated pipeline expression).
+    """
+    process = db["log_details"].find_one({"operation": operation, "name": "benchmark", "method": "benchmark"}, sort=[("_id", -1)])
+    if not process:
+        return "no process in log_details"
+    if backend == "journal":
+        found = db["log_entries"].count_documents({"collection": collection_name, "log_id": str(process["_id"])})
+    else:
+        found = db[collection_name].count_documents({"log.log_id": str(process["_id"])})
+    return f"{found} of {expected} documents logged" if found != expected else None
+
+def benchmarkCollection(db, counter, collection_name, arguments, work_directory):
+    """
+    Run every operation on a synthetic collection and return their measurements.
+    """
+    documents, backend = arguments.documents, arguments.log_backend
+    # mongomock doesn't run pipeline updates: some fail and others write the pipeline expressions as values
+    pipeline_reason = "pipeline updates are not supported by mongomock" if not arguments.uri else None
+    loadCollection(db, collection_name, documents, arguments.log_depth, backend)
+    stable_ids = [document["stable_id"] for document in db[collection_name].find({}, {"stable_id": 1})]
+    sampled_ids = random.sample(stable_ids, min(arguments.sample, len(stable_ids)))
+    results = []
+
+    # Insert new documents from a JSON Lines file
+    json_file = os.path.join(work_directory, f"{collection_name}.jsonl")
+    with open(json_file, "w") as f:
+        for i in range(documents, 2 * documents):
+            f.write(json.dumps(document_generators[collection_name](i)) + "\n")
+    results.append(measure("insert", collection_name, documents, counter, insert.insertDocuments,
+                           "insert", db, f"{collection_name}_insert", json_file, "benchmark", "benchmark", 1, backend, arguments.insert_mode,
+                           check=lambda: countProblem(db, f"{collection_name}_insert", {}, documents, "inserted")))
+
+    # Updates
+    results.append(measure("update_one", collection_name, len(sampled_ids), counter, lambda: [
+        update_value.updateOne("update_one", db, collection_name, {"stable_id": stable_id}, "status", "updated_one", "benchmark", "benchmark", backend)
+        for stable_id in sampled_ids], check=lambda: countProblem(db, collection_name, {"stable_id": {"$in": sampled_ids}, "status": "updated_one"}, len(sampled_ids), "updated")))
+    update_all_reason = pipeline_reason if arguments.engine == "server" else None
+    if update_all_reason:
+        results.append(unsupported("update_all", collection_name, documents, update_all_reason))
+    else:
+        results.append(measure("update_all", collection_name, documents, counter, update_value.updateAll,
+                               "update_all", db, collection_name, "status", "updated_all", "benchmark", "benchmark", arguments.engine, backend, arguments.batch_size,
+                               check=lambda: countProblem(db, collection_name, {"status": "updated_all"}, documents, "updated")))
+        update_all_id = str(db["log_details"].find_one({"operation": "update_all", "name": "benchmark", "method": "benchmark"}, sort=[("_id", -1)])["_id"])
+
+    csv_file = os.path.join(work_directory, f"{collection_name}.csv")
+    pd.DataFrame({"stable_id": stable_ids, "status": [f"file_{i}" for i in range(len(stable_ids))]}).to_csv(csv_file, index=False)
+    results.append(measure("update_with_file", collection_name, documents, counter, update_value.updateFile,
+                           "update_with_file", db, collection_name, csv_file, "benchmark", "benchmark", arguments.batch_size, backend,
+                           check=lambda: countProblem(db, collection_name, {"status": {"$regex": "^file_"}}, documents, "updated")))
+
+    # Restores to the values after update_all
+    if update_all_reason:
+        results += [unsupported(operation, collection_name, documents, f"update_all not measured, {update_all_reason}") for operation in ["restore_one", "restore_all"]]
+    else:
+        results.append(measure("restore_one", collection_name, len(sampled_ids), counter, lambda: [
+            restore_value.restoreOne("restore_one", db, collection_name, {"stable_id": stable_id}, update_all_id, "benchmark", "benchmark", backend)
+            for stable_id in sampled_ids], check=lambda: countProblem(db, collection_name, {"stable_id": {"$in": sampled_ids}, "status": "updated_all"}, len(sampled_ids), "restored")))
+        results.append(measure("restore_all", collection_name, documents, counter, restore_value.restoreAll,
+                               "restore_all", db, collection_name, update_all_id, "benchmark", "benchmark", arguments.batch_size, backend,
+                               check=lambda: countProblem(db, collection_name, {"status": "updated_all"}, documents, "restored")))
+
+    # Field operations, run as pipeline updates
+    if pipeline_reason:
+        results += [unsupported(operation, collection_name, documents, pipeline_reason) for operation in ["add_empty_field", "rename_field", "remove_field"]]
+        return results
+    results.append(measure("add_empty_field", collection_name, documents, counter, new_field.addNullField,
+                           "add_empty_field", db, collection_name, "benchmark_field", "benchmark", "benchmark", backend,
+                           check=lambda: countProblem(db, collection_name, {"benchmark_field": {"$exists": True}}, documents, "with the field") or logProblem(db, collection_name, "add_empty_field", backend, documents)))
+    results.append(measure("rename_field", collection_name, documents, counter, rename_field.renameField,
+                           "rename_field", db, collection_name, "benchmark_field", "benchmark_renamed", "benchmark", "benchmark", backend,
+                           check=lambda: countProblem(db, collection_name, {"benchmark_renamed": {"$exists": True}}, documents, "with the renamed field") or logProblem(db, collection_name, "rename_field", backend, documents)))
+    results.append(measure("remove_field", collection_name, documents, counter, remove_field.removeField,
+                           "remove_field", db, collection_name, "benchmark_renamed", "benchmark", "benchmark", backend,
+                           check=lambda: countProblem(db, collection_name, {"benchmark_renamed": {"$exists": False}}, documents, "without the field") or logProblem(db, collection_name, "remove_field", backend, documents)))
+    return results
+
+# ----------
+# Results
+# ----------
+def gitCommit():
+    """
+    Return the commit of the repository the benchmarks run on, if it's a git repository.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(results_directory), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def compareResults(old_file, new_file):
+    """
+    Print the change of duration, round trips and peak memory of every operation between two result files.
+    """
+    with open(old_file) as f:
+        old = {(result["operation"], result["collection"]): result for result in json.load(f)["results"]}
+    with open(new_file) as f:
+        new = json.load(f)["results"]
+
+    print(f"{'operation':>16} {'collection':>10} {'seconds':>18} {'round trips':>18} {'peak MB':>18}")
+    for result in new:
+        previous = old.get((result["operation"], result["collection"]))
+        if not previous:
+            continue
+        if previous["error"] or result["error"]:
+            print(f"{result['operation']:>16} {result['collection']:>10} failed in {'both results' if previous['error'] and result['error'] else 'the old results' if previous['error'] else 'the new results'}")
+            continue
+        columns = []
+        for key in ["seconds", "round_trips", "peak_memory_mb"]:
+            before, after = previous[key], result[key]
+            change = f" ({(after - before) / before:+.0%})" if before and after is not None else ""
+            columns.append(f"{before} -> {after}{change}" if before is not None else "n/a")
+        print(f"{result['operation']:>16} {result['collection']:>10} " + " ".join(f"{column:>18}" for column in columns))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the BioMongo tools operations on synthetic EGA collections.")
+    parser.add_argument("--uri", default="", help="MongoDB URI of a local mongod (e.g. mongodb://localhost:27017). mongomock is used if empty.")
+    parser.add_argument("--collections", default="file,sample,dataset", help=f"Collections to generate, among: {', '.join(document_generators)}.")
+    parser.add_argument("--documents", type=int, default=1000, help="Documents per collection.")
+    parser.add_argument("--log-depth", type=int, default=5, help="Log entries of every document before the benchmark.")
+    parser.add_argument("--sample", type=int, default=100, help="Documents used by update_one and restore_one.")
+    parser.add_argument("--log-backend", default="embedded", choices=["embedded", "journal"])
+    parser.add_argument("--insert-mode", default="checked", choices=["checked", "single_pass"])
+    parser.add_argument("--engine", default="client", choices=["client", "server"])
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="", help="Result file, by default a new file in benchmarks/results.")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files instead of running the benchmarks.")
+    arguments = parser.parse_args()
+
+    if arguments.compare:
+        compareResults(*arguments.compare)
+        return
+
+    random.seed(arguments.seed)
+    if arguments.uri:
+        counter = RoundTripCounter()
+        client = MongoClient(arguments.uri, event_listeners=[counter])
+        target = "mongod"
+    else:
+        import mongomock
+        counter = None  # mongomock doesn't send commands, round trips can't be counted
+        client = mongomock.MongoClient()
+        target = "mongomock"
+        scan_functions.raw_bson = False
+
+    db = client["biomongo_benchmark"]
+    results = []
+    with tempfile.TemporaryDirectory() as work_directory:
+        for collection_name in arguments.collections.split(","):
+            client.drop_database("biomongo_benchmark")
+            results += benchmarkCollection(db, counter, collection_name, arguments, work_directory)
+    client.drop_database("biomongo_benchmark")
+
+    # Save the results with the version they were measured on
+    commit = gitCommit()
+    output = arguments.output or os.path.join(results_directory, f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{commit}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"commit": commit, "date": datetime.now().isoformat(), "target": target, "settings": vars(arguments), "results": results}, f, indent=2)
+    print(f"Results saved to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -7,11 +7,12 @@
 # ----------
 # General information
 # ----------
-operation='' # Operations: insert, update_one, update_all, update_with_file, restore_one, restore_all, add_empty_field, rename_field, remove_field
+operation='' # Operations: insert, update_one, update_all, update_with_file, restore_one, restore_all, add_empty_field, rename_field, remove_field, ensure_indexes, resume, history
 name='' # Name of the person that does this operation.
 method='' # Method used to obtain or modify the data (e.g. Raw data EGAPRO).
 database_name='' # Name of the database.
 collection_name='' # Collection to be managed (analysis, dac, dataset, experiment, file, policy, run, sample, study).
+log_backend='embedded' # Where the log entries of the documents are stored: 'embedded' (log array inside every document) or 'journal' (log_entries collection).
 
 
 # Depending on the operation you should include the relevant information.
@@ -19,7 +20,8 @@ collection_name='' # Collection to be managed (analysis, dac, dataset, experimen
 # ---------
 # Insert needs:
 # ----------
-json_documents=f'' # Path to a json document or directory to be inserted.
+json_documents=f'' # Path to a json document or directory to be inserted. Parquet and Arrow files (one document per row) are also inserted if pyarrow is installed.
+insert_mode='checked' # 'checked' looks up the existing stable_ids before inserting, 'single_pass' inserts the documents with their log in one write and relies on the unique stable_id index (see ensure_indexes) to skip the existing ones.
 
 # ----------
 # Update operations need: 
@@ -28,7 +30,10 @@ update_field='' # Target field to be updated (for update_one and update_all).
 new_value='' # New value for the field (for update_one and update_all).
 update_criteria={'stable_id':''} # Criteria for update_one, the first element should be the field name to match (stable_id), and the second should be the actual stable_id value.
 # If using update_with_file please provide the path of the CSV with the information or the path of the directory with the CSVs.  
+# The first column is the field to match (e.g. stable_id) and every other column a field to update, all of them are updated in one write per document.
+# Parquet and Arrow files are also accepted if pyarrow is installed, the fields of their struct columns are embedded fields (e.g. archived_at.crg).
 update_file = ''
+validation='report' # Check the files before updating: values to match repeated in a file or in earlier files, not in the collection or empty. 'report' reports them and updates, 'strict' doesn't update if there are any, '' doesn't check.
 # Important to consider
 ## If you want to add a list as a new value, separate the values with ";".
 ## If you want to modify an embedded/nested field, use dot notation (e.g. archived_at.crg)  
@@ -55,3 +60,45 @@ new_field_name='' # New name for the above stated field
 # ---------
 # Take into account that you will remove the information from the field in all the files in the colection.
 field_to_remove='' # Name of the field to be removed.
+
+# ---------
+# Ensure indexes needs:
+# ---------
+# Only the database and collection names (and log_backend), name and method are not needed. The indexes used by the operations are created if they are missing.
+
+# ---------
+# History needs:
+# ---------
+history_criteria={} # Criteria of the documents to rebuild (e.g. {'stable_id': 'EGAS00001000001'}), empty for all the documents of the collection.
+history_log_id='' # Log id of the process the documents are rebuilt at (their state right after it).
+history_date='' # Date the documents are rebuilt at if there's no history_log_id (e.g. '2024-05-31T12:00:00').
+history_fields=[] # Fields to include (embedded fields in dot notation), empty for the whole documents.
+history_file='history.jsonl' # JSON Lines file the documents are written to, empty to write them to the standard output. Nothing is written to the database.
+
+# ---------
+# Resume needs:
+# ---------
+resume_log_id='' # Log id of the interrupted process (insert, update_all, update_with_file or restore_all) to continue. If empty, the last unfinished process of your name in the collection is resumed.
+
+# ---------
+# Performance options:
+# ---------
+batch_size=1000 # Number of documents looked up together, and initial size of the bulk writes, adjusted to their round-trip time (for insert, update_all, update_with_file and restore_all).
+engine='client' # Engine for update_all: 'client' compares and writes every document from Python, 'server' runs a single pipeline update in MongoDB (requires MongoDB 4.2 or later).
+snapshot_interval=0 # Store the full value of the field in about one of every snapshot_interval log entries, so restores replay only the entries after the nearest one (for update_one, update_all, update_with_file, restore_one and restore_all). 0 stores no snapshots.
+in_flight=0 # Number of batches read ahead and written in background threads while the current one is processed, so reads and writes overlap (for update_all, update_with_file and restore_all). 0 reads, processes and writes every batch in turn.
+workers=1 # Number of processes used to insert or update the files of a directory in parallel (for insert and update_with_file). Files of update_with_file that update the same fields of the same documents are updated in order by the same process.
+
+# ---------
+# Metrics options:
+# ---------
+# The metrics of every process (time per phase, documents scanned and modified, bulk write latencies, bytes written, peak memory) are saved in its log_details document. The bytes read are also measured when the metrics are exported.
+metrics_export='' # Also export them: 'json' appends one JSON line per process to metrics_file, 'prometheus' writes the metrics of the last process to metrics_file for the textfile collector of the node exporter. '' doesn't export them.
+metrics_file='metrics.jsonl' # File the metrics are exported to (e.g. 'metrics.jsonl' or '/var/lib/node_exporter/biomongo.prom').
+
+# ---------
+# Report options:
+# ---------
+verbosity=1 # 0 shows only warnings and errors, 1 also the results and a progress line every progress_interval seconds, 2 also a line for every document (slow for large collections).
+progress_interval=10 # Seconds between progress lines of the operations over many documents (insert, update_all, update_with_file and restore_all).
+report_file='' # Gzip-compressed text file the line of every document is appended to, whatever the verbosity (e.g. 'report.txt.gz'). Empty doesn't write it.
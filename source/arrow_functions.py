@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""arrow_functions.py  :  Read Parquet and Arrow files in batches of columns """
+
+__author__ = "Marta Huertas"
+__version__ = "0.1"
+__maintainer__ = "Aldar Cabrelles"
+__email__ = "aldar.cabrelles@crg.eu"
+__status__ = "development"
+
+# Import Packages
+from . import report
+
+# Read Parquet and Arrow files with pyarrow if it's installed, they can't be read without it
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pa = None
+
+parquet_extensions = ('.parquet', '.pq')
+arrow_extensions = parquet_extensions + ('.arrow', '.feather', '.ipc')
+
+def checkPyarrow(path):
+    """
+    Check that pyarrow is installed to read a Parquet or Arrow file, warning about the file if it isn't.
+    """
+    if pa is None:
+        report.warning(f"{path} can't be read, Parquet and Arrow files need pyarrow (pip install pyarrow).")
+        return False
+    return True
+
+def openArrowFile(path):
+    """
+    Open an Arrow IPC file (Feather v2), or an Arrow IPC stream if it isn't a file.
+    """
+    try:
+        return pa.ipc.open_file(path)
+    except pa.ArrowInvalid:
+        return pa.ipc.open_stream(path)
+
+def arrowBatches(path):
+    """
+    Yield the record batches of an Arrow IPC file or stream, one at a time.
+    """
+    reader = openArrowFile(path)
+    if isinstance(reader, pa.ipc.RecordBatchFileReader):
+        for index in range(reader.num_record_batches):
+            yield reader.get_batch(index)
+    else:
+        yield from reader
+
+def flattenFields(schema_fields, prefix=""):
+    """
+    Return the names of the leaf fields of a schema in dot notation: the fields of struct columns are embedded fields.
+    """
+    names = []
+    for field in schema_fields:
+        if pa.types.is_struct(field.type):
+            names += flattenFields(list(field.type), f"{prefix}{field.name}.")
+        else:
+            names.append(f"{prefix}{field.name}")
+    return names
+
+def readSchema(path):
+    """
+    Read the schema of a Parquet or Arrow file without reading its data.
+    """
+    if path.endswith(parquet_extensions):
+        return pa.parquet.read_schema(path)
+    return openArrowFile(path).schema
+
+def fieldNames(path):
+    """
+    Return the fields of a Parquet or Arrow file in dot notation, in the order of its columns.
+    """
+    return flattenFields(list(readSchema(path)))
+
+def countRows(path):
+    """
+    Count the rows of a Parquet or Arrow file from its metadata or its batch headers, without reading the values.
+    """
+    if path.endswith(parquet_extensions):
+        return pa.parquet.ParquetFile(path).metadata.num_rows
+    return sum(batch.num_rows for batch in arrowBatches(path))
+
+def readBatches(path, columns=None, batch_size=1000, skip_rows=0):
+    """
+    Yield the rows of a Parquet or Arrow file as tables of batch_size rows at most, after skipping the first skip_rows rows.
+    columns are the top-level columns to read, the other columns of a Parquet file are not read from disk.
+    """
+    if path.endswith(parquet_extensions):
+        batches = pa.parquet.ParquetFile(path).iter_batches(batch_size=batch_size, columns=columns)
+    else:
+        batches = (batch.select(columns) if columns else batch for batch in arrowBatches(path))
+
+    for batch in batches:
+        if skip_rows >= batch.num_rows:
+            skip_rows -= batch.num_rows
+            continue
+        batch, skip_rows = batch.slice(skip_rows), 0
+        # Arrow files keep the batches they were written with, split them in batches of batch_size rows
+        for start in range(0, batch.num_rows, batch_size):
+            yield pa.Table.from_batches([batch.slice(start, batch_size)])
+
+def flattenColumns(table):
+    """
+    Map the fields of the struct columns of a table to columns named with their path in dot notation, down to the leaf fields.
+    """
+    while any(pa.types.is_struct(field.type) for field in table.schema):
+        table = table.flatten()
+    return table
+
+def castDates(table):
+    """
+    Convert the date columns of a table into timestamps, BSON stores dates as datetimes.
+    """
+    for index, field in enumerate(table.schema):
+        if pa.types.is_date(field.type):
+            table = table.set_column(index, field.name, table.column(index).cast(pa.timestamp("ms")))
+    return table
+
+def readColumns(path, fields, batch_size=1000, skip_rows=0):
+    """
+    Yield the values of the given fields (dot notation) of a Parquet or Arrow file, a list of Python values per field for every batch of batch_size rows.
+    Only the columns of the fields are read and the values are converted column by column, no document is built for the rows.
+    """
+    columns = [name for name in readSchema(path).names if any(field == name or field.startswith(f"{name}.") for field in fields)]
+    for table in readBatches(path, columns, batch_size, skip_rows):
+        table = castDates(flattenColumns(table))
+        yield [table.column(field).to_pylist() for field in fields]
+
+def dropNulls(value):
+    """
+    Remove the fields without value (null in the file) from a document and its embedded documents.
+    """
+    if isinstance(value, dict):
+        return {key: dropNulls(element) for key, element in value.items() if element is not None}
+    if isinstance(value, list):
+        return [dropNulls(element) for element in value]
+    return value
+
+def readDocuments(path, batch_size=1000, skip_rows=0):
+    """
+    Yield the rows of a Parquet or Arrow file as documents, after skipping the first skip_rows rows: struct columns are embedded documents
+    and columns without value in a row are not added to its document, as if the documents had been written as JSON.
+    The documents are built one batch at a time, as they are read.
+    """
+    for table in readBatches(path, None, batch_size, skip_rows):
+        for document in castDates(table).to_pylist():
+            yield dropNulls(document)
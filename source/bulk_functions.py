@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+"""bulk_functions.py  :  Send write operations to MongoDB in adaptive bulk writes """
+
+__author__ = "Marta Huertas"
+__version__ = "0.1"
+__maintainer__ = "Aldar Cabrelles"
+__email__ = "aldar.cabrelles@crg.eu"
+__status__ = "development"
+
+# Import Packages
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import bson
+from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+from . import scan_functions, metrics
+
+# Limits of a bulk write
+min_batch_operations = 100
+max_batch_operations = 100000  # maxWriteBatchSize of MongoDB
+max_batch_bytes = 16 * 1024 * 1024  # Encoded BSON bytes of the operations in a batch
+target_batch_seconds = 1.0  # Round-trip time the batch size is adjusted to
+
+class BulkWriter:
+    """
+    Collect write operations for a collection and send them in bulk writes.
+    A batch is sent when it reaches max_operations operations or max_batch_bytes encoded bytes, and max_operations
+    grows or shrinks with the measured round-trip time of the batches, so that each one takes about target_batch_seconds.
+    With in_flight > 0 the batches are written in order by a background thread while the next ones are prepared,
+    with up to in_flight batches waiting to be written.
+    """
+
+    def __init__(self, collection, storage=None, batch_size=1000, ordered=False, ignore_duplicates=False, checkpoint=None, in_flight=0):
+        self.collection = collection
+        self.storage = storage  # Log storage, its pending entries are written after every batch
+        self.checkpoint = checkpoint  # Called with the progress of the last operation of every batch once it's written
+        self.in_flight = in_flight
+        if in_flight:
+            # A single thread keeps the batches in order, so the updates of a document are applied in the order they were queued
+            self.executor = ThreadPoolExecutor(max_workers=1)
+            self.slots = threading.BoundedSemaphore(in_flight)
+            self.futures = []  # (future, keys of the batch) of the batches handed to the background thread
+            self.failed = False
+        self.ordered = ordered
+        self.ignore_duplicates = ignore_duplicates  # Count duplicate key errors as existing documents instead of failing
+        self.max_operations = min(max(batch_size, min_batch_operations), max_batch_operations)
+
+        self.operations = []
+        self.keys = set()
+        self.inserted_logs = []
+        self.log_entries = []
+        self.batch_bytes = 0
+        self.progress = None
+
+        # Totals across batches
+        self.modified_count = 0
+        self.inserted_count = 0
+        self.duplicate_count = 0
+        self.batches = 0
+
+    def encodeDocument(self, document):
+        """
+        Encode a document once, so its size is known and the driver doesn't have to encode it again.
+        """
+        if not scan_functions.raw_bson:
+            return document, len(bson.encode(document))
+        raw_document = RawBSONDocument(bson.encode(document))
+        return raw_document, len(raw_document.raw)
+
+    def add(self, operation, size, key=None, inserted_log=None, progress=None):
+        """
+        Queue an operation of the given encoded size, sending the batch first if the operation doesn't fit in it.
+        Operations with the same key (e.g. a document _id) are never sent in the same batch.
+        inserted_log is the (document _id, log entry) to write through the log storage once the operation succeeds.
+        The log entries queued in the log storage for the operation (see JournalLog.logUpdates) are written once it succeeds too.
+        progress is the point of the operation in the input (e.g. the _id or row number), passed to the checkpoint once it's written.
+        """
+        # The log entries queued since the previous operation belong to this one
+        log_entries = self.storage.takePending() if self.storage else []
+
+        if self.operations and (self.batch_bytes + size > max_batch_bytes or (key is not None and key in self.keys)):
+            self.send()
+
+        if inserted_log is not None:
+            self.inserted_logs.append((len(self.operations), *inserted_log))
+        self.log_entries += [(len(self.operations), log_entry) for log_entry in log_entries]
+        self.operations.append(operation)
+        self.batch_bytes += size
+        if progress is not None:
+            self.progress = progress
+        if key is not None:
+            self.keys.add(key)
+
+        if len(self.operations) >= self.max_operations:
+            self.send()
+
+    def update(self, filter, update, key=None, progress=None):
+        """
+        Queue the update of one document.
+        """
+        if isinstance(update, list):
+            # Pipeline updates can't be sent as raw documents, they are only encoded to be measured
+            size = len(bson.encode({"q": filter, "u": update}))
+        else:
+            update, size = self.encodeDocument(update)
+        self.add(UpdateOne(filter, update), size, key, progress=progress)
+
+    def insert(self, document, log_entry=None, progress=None):
+        """
+        Queue the insertion of one document. Its _id is generated here if it doesn't have one.
+        With a log entry, the document is logged through the log storage once it's inserted.
+        """
+        document.setdefault("_id", ObjectId())
+        raw_document, size = self.encodeDocument(document)
+        inserted_log = (document["_id"], log_entry) if log_entry is not None else None
+        self.add(InsertOne(raw_document), size, document["_id"], inserted_log, progress)
+
+    def send(self):
+        """
+        Send the queued operations as one batch: written right away, or handed to the background thread if in_flight is set.
+        """
+        if not self.operations:
+            return
+
+        # The log entries of the operations of this batch are written with it
+        metrics.count("bytes_written", self.batch_bytes)
+        batch = (self.operations, self.inserted_logs, self.progress, self.log_entries)
+        keys = self.keys
+        self.operations, self.inserted_logs, self.log_entries, self.keys, self.batch_bytes, self.progress = [], [], [], set(), 0, None
+
+        if not self.in_flight:
+            self.writeBatch(*batch)
+            return
+
+        # Wait for a free slot, so no more than in_flight batches are held in memory
+        self.raiseErrors()
+        with metrics.phase("wait"):
+            self.slots.acquire()
+        future = self.executor.submit(self.writeBackground, *batch)
+        future.add_done_callback(lambda future: self.slots.release())
+        self.futures.append((future, keys))
+
+    def raiseErrors(self):
+        """
+        Raise the error of the first batch written in the background that failed, and forget the batches already written.
+        """
+        for future, keys in [(future, keys) for future, keys in self.futures if future.done()]:
+            self.futures.remove((future, keys))
+            future.result()
+
+    def flush(self):
+        """
+        Send the queued operations and wait until every batch is written.
+        """
+        self.send()
+        if self.in_flight:
+            with metrics.phase("wait"):
+                for future, _ in self.futures:
+                    future.result()
+            self.futures = []
+
+    def pending(self, keys):
+        """
+        Check if any of the keys (e.g. document _ids) has an operation that isn't written yet, queued or in a batch in flight.
+        Documents read from the collection before their pending operations are written would be out of date.
+        """
+        if not self.keys.isdisjoint(keys):
+            return True
+        return bool(self.in_flight) and any(not future.done() and not batch_keys.isdisjoint(keys) for future, batch_keys in self.futures)
+
+    def writeBackground(self, *batch):
+        """
+        Write a batch in the background thread. Once a batch fails the next ones are dropped, so the progress recorded never skips a failed batch.
+        """
+        if self.failed:
+            return
+        try:
+            self.writeBatch(*batch)
+        except Exception:
+            self.failed = True
+            raise
+
+    def writeBatch(self, operations, inserted_logs, progress, log_entries):
+        """
+        Write a batch in one bulk write and adjust the size of the next batches to its round-trip time.
+        """
+        with metrics.phase("write"):
+            self.writeOperations(operations, inserted_logs, progress, log_entries)
+
+    def writeOperations(self, operations, inserted_logs, progress, log_entries):
+        """
+        Send the operations of a batch, write their log entries and record the progress.
+        log_entries are the (index of the operation, log entry) of the batch.
+        """
+        start = time.perf_counter()
+        try:
+            details = self.collection.bulk_write(operations, ordered=self.ordered).bulk_api_result
+            rejected_operations = set()
+        except BulkWriteError as e:
+            # Duplicate key errors are the documents already existing in the collection, anything else is a real error
+            details = e.details
+            write_errors = details.get("writeErrors", [])
+            rejected_operations = {error["index"] for error in write_errors}
+            if not self.ignore_duplicates or details.get("writeConcernErrors") or any(error["code"] != 11000 for error in write_errors):
+                # The operations that were applied are logged before failing, an ordered batch stops at its first error
+                if self.ordered and write_errors:
+                    rejected_operations.update(range(min(rejected_operations), len(operations)))
+                self.writeLogs(inserted_logs, log_entries, rejected_operations)
+                raise
+        elapsed = time.perf_counter() - start
+
+        self.batches += 1
+        self.modified_count += details.get("nModified", 0)
+        self.inserted_count += details.get("nInserted", 0)
+        self.duplicate_count += len(rejected_operations)
+        if metrics.current:
+            metrics.current.batchWritten(elapsed, details.get("nModified", 0), details.get("nInserted", 0))
+
+        # Write the log entries of the batch
+        self.writeLogs(inserted_logs, log_entries, rejected_operations)
+
+        # Record how far the input has been written
+        if self.checkpoint and progress is not None:
+            self.checkpoint(progress)
+
+        self.adjustBatchSize(len(operations), elapsed)
+
+    def writeLogs(self, inserted_logs, log_entries, rejected_operations):
+        """
+        Write the log entries of the operations of a batch that were applied, leaving out the rejected_operations (their indexes in the batch).
+        """
+        if not self.storage:
+            return
+        entries = [log_entry for index, log_entry in log_entries if index not in rejected_operations]
+        logs = {}
+        for index, document_id, log_entry in inserted_logs:
+            if index not in rejected_operations:
+                logs.setdefault(id(log_entry), (log_entry, []))[1].append(document_id)
+        for log_entry, document_ids in logs.values():
+            entries += self.storage.insertedEntries(document_ids, log_entry)
+        self.storage.writeEntries(entries)
+
+    def adjustBatchSize(self, operations, elapsed):
+        """
+        Halve the batch size when a batch is slower than the target, and double it when a full batch is much faster.
+        """
+        if elapsed > target_batch_seconds * 1.5:
+            self.max_operations = max(min_batch_operations, self.max_operations // 2)
+        elif elapsed < target_batch_seconds / 2 and operations >= self.max_operations:
+            self.max_operations = min(max_batch_operations, self.max_operations * 2)
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+
+"""connection.py  :  Open connections to the BioMongoDB """
+
+__author__ = "Marta Huertas"
+__version__ = "0.1"
+__maintainer__ = "Aldar Cabrelles"
+__email__ = "aldar.cabrelles@crg.eu"
+__status__ = "development"
+
+# Import Packages
+from pymongo import MongoClient
+from . import mongoConnection, metrics, report
+
+# Connection of a worker process of a pool, opened by initWorker
+worker_db = None
+
+def connectDatabase(database_name):
+    """
+    Open a new connection to MongoDB with the credentials in mongoConnection and return the database.
+    Every process needs its own connection, a MongoClient can't be shared across a fork.
+    The commands sent are measured for the metrics of the operations (see metrics.CommandMetrics).
+    """
+    client = MongoClient(mongoConnection.mongo_host, mongoConnection.mongo_port, username=mongoConnection.username, password=mongoConnection.password, authSource=mongoConnection.auth_source, event_listeners=[metrics.listener])
+    return client[database_name]
+
+def initWorker(database_name):
+    """
+    Open the MongoDB connection of a worker process, used as the initializer of the pools of workers.
+    """
+    global worker_db
+    worker_db = connectDatabase(database_name)
+    report.initWorker()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+"""history.py  :  Rebuild documents as they were at a log_id or date, without modifying them """
+
+__author__ = "Marta Huertas"
+__version__ = "0.1"
+__maintainer__ = "Aldar Cabrelles"
+__email__ = "aldar.cabrelles@crg.eu"
+__status__ = "development"
+
+# Import Packages
+import sys
+from datetime import datetime, timezone
+from itertools import islice
+from bson import json_util
+from bson.objectid import ObjectId
+from . import log_storage, scan_functions, update_value, restore_value, report
+
+def laterProcesses(db, log_id=None, date=None):
+    """
+    Return the log_ids of the processes that started after the process log_id, or after the date (a datetime or an ISO date string, local time if it has no time zone).
+    The processes are ordered by the UTC time they started at, with millisecond precision. Processes that ran at the same time (e.g. parallel workers,
+    or a resumed process that kept writing after later ones started) are ordered by their start only, their changes can't be told apart by time.
+    Processes logged before the start time was recorded are ordered by their date, to the second.
+    """
+    if log_id:
+        process = db['log_details'].find_one({"_id": ObjectId(log_id)}, {"date": 1, "started": 1})
+        if not process:
+            return set()
+        # pymongo reads dates as naive UTC datetimes
+        started = process["started"].replace(tzinfo=timezone.utc) if process.get("started") else ObjectId(log_id).generation_time
+        date_text = process["date"]
+    else:
+        date = datetime.fromisoformat(date) if isinstance(date, str) else date
+        started = date.astimezone(timezone.utc)
+        date_text = date.astimezone().strftime('%Y-%m-%dT%H:%M:%S+00:00')
+    query = {"$or": [{"started": {"$gt": started}}, {"started": {"$exists": False}, "date": {"$gt": date_text}}]}
+    return {str(process["_id"]) for process in db['log_details'].find(query, {"_id": 1})}
+
+def unsetFieldValue(document, field):
+    """
+    Remove an embedded or non-embedded field from a local copy of a document using dot notation.
+    Embedded documents left empty are removed too, as they were created with the field.
+    """
+    key, _, rest = field.partition(".")
+    if not rest:
+        document.pop(key, None)
+    elif isinstance(document.get(key), dict):
+        unsetFieldValue(document[key], rest)
+        if not document[key]:
+            del document[key]
+
+def entryFields(entry, changed_values):
+    """
+    Return the fields changed by a log entry: the modified field, or both names of a renamed field.
+    """
+    if entry.get('operation') == 'rename_field':
+        return [changed_values['removed'][0], changed_values['added'][0]]
+    return [entry.get('modified_field')]
+
+def projectFields(document, fields):
+    """
+    Keep only the given fields (dot notation) of a rebuilt document, with its _id and stable_id.
+    """
+    projected = {key: document[key] for key in ("_id", "stable_id") if key in document}
+    for field in scan_functions.fieldProjection(fields):
+        value = scan_functions.getFieldValue(document, field)
+        if value is not None:
+            update_value.setFieldValue(projected, field, value)
+    return projected
+
+def documentAt(document, log_entries, later_ids, fields=None):
+    """
+    Rebuild a document as it was before the processes of later_ids, undoing their log entries (newest first) as restore_value does.
+    With fields, only the entries of those fields are undone and only those fields are kept.
+    Returns None if the document was inserted by one of those processes.
+    """
+    for entry in log_entries:
+        if entry.get('log_id') not in later_ids:
+            continue
+        if entry.get('operation') == 'insert':
+            return None
+
+        modified_field = entry.get('modified_field')
+        if not modified_field:
+            continue
+        changed_values = scan_functions.decodeValue(entry.get('changed_values'))
+        if fields and not update_value.fieldsOverlap(fields, entryFields(entry, changed_values)):
+            continue
+
+        if entry.get('operation') == 'rename_field':
+            # The entry records the old name as removed and the new name as added: move the value back
+            old_name, new_name = changed_values['removed'][0], changed_values['added'][0]
+            value = scan_functions.getFieldValue(document, new_name)
+            unsetFieldValue(document, new_name)
+            if value is not None:
+                update_value.setFieldValue(document, old_name, value)
+        elif changed_values is None:
+            # Entries without changed_values created the field
+            unsetFieldValue(document, modified_field)
+        else:
+            current_value = scan_functions.getFieldValue(document, modified_field)
+            value_list = restore_value.applyChange(restore_value.valueList(current_value), changed_values.get('added', []), changed_values.get('removed', []))
+            update_value.setFieldValue(document, modified_field, value_list[0] if len(value_list) == 1 else value_list)
+
+    # Keep only the log entries of the rebuilt version
+    if "log" in document:
+        document["log"] = [entry for entry in document["log"] if entry.get('log_id') not in later_ids]
+    return projectFields(document, fields) if fields else document
+
+def documentsAt(db, collection_name, query=None, log_id=None, date=None, fields=None, log_backend='embedded', batch_size=1000):
+    """
+    Yield the documents matching the query as they were right after the process log_id, or at the date, with only the given fields if any.
+    The documents are read with a cursor and their logs in batches of batch_size documents. Nothing is written to the database.
+    """
+    collection = db[collection_name]
+    storage = log_storage.getLogStorage(db, collection_name, log_backend)
+    later_ids = laterProcesses(db, log_id, date)
+
+    # A renamed field is rebuilt from its other name, which may not be among the fields: the whole documents are read if a later process renamed a field
+    renamed = fields and db['log_details'].count_documents({"_id": {"$in": [ObjectId(later_id) for later_id in later_ids]}, "operation": "rename_field"}, limit=1)
+    if fields and not renamed:
+        # The log is read to rebuild the documents, and dropped from the output unless it was asked for
+        documents = scan_functions.scanDocuments(collection, query or {}, ["stable_id", "log"] + fields, raw=False)
+    else:
+        documents = collection.find(query or {})
+
+    while True:
+        batch = list(islice(documents, batch_size))
+        if not batch:
+            break
+        logs = storage.documentLogs(batch)
+        for document in batch:
+            document = documentAt(document, logs[document["_id"]], later_ids, fields)
+            if document is not None:
+                yield document
+
+def exportHistory(db, collection_name, history_file, query=None, log_id=None, date=None, fields=None, log_backend='embedded'):
+    """
+    Write the documents matching the query as they were at log_id or date to a JSON Lines file (or to the standard output if history_file is empty).
+    """
+    output = open(history_file, "w") if history_file else sys.stdout
+    exported_documents = 0
+    try:
+        for document in documentsAt(db, collection_name, query, log_id, date, fields, log_backend):
+            output.write(json_util.dumps(document) + "\n")
+            exported_documents += 1
+    finally:
+        if history_file:
+            output.close()
+
+    # The summary goes to the standard error when the documents are written to the standard output
+    point = f"log {log_id}" if log_id else f"date {date}"
+    destination = f" to {history_file}" if history_file else ""
+    report.message(f"{exported_documents} document(s) of the {collection_name} collection exported as of {point}{destination}.", file=sys.stdout if history_file else sys.stderr)
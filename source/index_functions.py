@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+"""index_functions.py  :  Create and check the indexes the operations rely on """
+
+__author__ = "Marta Huertas"
+__version__ = "0.1"
+__maintainer__ = "Aldar Cabrelles"
+__email__ = "aldar.cabrelles@crg.eu"
+__status__ = "development"
+
+# Import Packages
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+from . import report
+
+# Indexes of the log_entries journal: entries of a document in order, and entries of a process by field
+journal_indexes = [
+    [("collection", ASCENDING), ("document_id", ASCENDING), ("date", DESCENDING)],
+    [("log_id", ASCENDING), ("modified_field", ASCENDING)]
+]
+
+def requiredIndexes(collection_name, log_backend='embedded'):
+    """
+    List the indexes the operations rely on as (collection, keys, options):
+    - stable_id (unique): insert dedup, update_one/restore_one criteria and update_with_file lookups.
+    - log.log_id or the journal indexes: restore_all.
+    - date, collection and name in log_details: finding the processes.
+    """
+    indexes = [
+        (collection_name, [("stable_id", ASCENDING)], {"unique": True}),
+        ("log_details", [("date", ASCENDING), ("collection", ASCENDING), ("name", ASCENDING)], {})
+    ]
+    if log_backend == 'journal':
+        indexes += [("log_entries", keys, {}) for keys in journal_indexes]
+    else:
+        indexes.append((collection_name, [("log.log_id", ASCENDING)], {}))
+    return indexes
+
+def findIndex(collection, keys):
+    """
+    Return the information of the index of the collection with exactly these keys, or None if there's no such index.
+    """
+    return next((index for index in collection.list_indexes() if list(index["key"].items()) == keys), None)
+
+def hasIndexOn(collection, field):
+    """
+    Check if the collection has an index that can be used to look up documents by the field (an index starting with the field).
+    """
+    return any(next(iter(index["key"])) == field for index in collection.list_indexes())
+
+def ensureIndex(collection, keys, **options):
+    """
+    Create the index if the collection doesn't have it yet. Returns True if the index was created.
+    """
+    if findIndex(collection, keys):
+        return False
+    report.message(f"Creating index on {', '.join(key for key, _ in keys)} in the {collection.name} collection.")
+    collection.create_index(keys, **options)
+    return True
+
+def reportMissingIndexes(collection, fields):
+    """
+    Warn about the fields used to look up documents that have no index, before a heavy operation starts.
+    Returns the list of fields without index.
+    """
+    missing_fields = [field for field in fields if not hasIndexOn(collection, field)]
+    for field in missing_fields:
+        report.warning(f"Warning: there's no index on {field} in the {collection.name} collection, lookups will scan the whole collection. Run the ensure_indexes operation to create it.")
+    return missing_fields
+
+def ensureIndexes(db, collection_name, log_backend='embedded'):
+    """
+    Create the indexes the operations rely on and report the ones that already exist or can't be created.
+    """
+    for index_collection, keys, options in requiredIndexes(collection_name, log_backend):
+        collection = db[index_collection]
+        index_name = ', '.join(key for key, _ in keys)
+        existing_index = findIndex(collection, keys)
+
+        if existing_index:
+            if options.get("unique") and not existing_index.get("unique"):
+                report.warning(f"Index on {index_name} in the {index_collection} collection exists but is not unique. Drop it and run ensure_indexes again to make it unique.")
+            else:
+                report.message(f"Index on {index_name} in the {index_collection} collection already exists.")
+            continue
+
+        try:
+            ensureIndex(collection, keys, **options)
+        except OperationFailure as e:
+            # e.g. duplicated stable_ids prevent the creation of a unique index
+            report.warning(f"Index on {index_name} in the {index_collection} collection could not be created: {e}")
@@ -12,16 +12,316 @@ __status__ = "development"
 # Import Packages
 import json
 import re
-from pymongo import UpdateOne
-from . import log_functions
+from itertools import islice
+from multiprocessing import Pool
+from bson.objectid import ObjectId
+from . import log_functions, log_storage, index_functions, connection, bulk_functions, arrow_functions, metrics, report
 import os
 
-def insertDocuments(operation, db, collection_name, json_documents, name, method):
+# Use orjson to decode JSON Lines documents and JSON files if it's installed, it is several times faster than json
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json.loads
+
+json_extensions = ('.json', '.jsonl', '.ndjson')
+max_decoded_bytes = 64 * 1024 * 1024  # JSON files up to this size are decoded in one call (with orjson if it's installed), larger ones are streamed
+
+def streamJsonArray(f, read_size=1 << 20):
+    """
+    Yield the elements of a JSON array one at a time while reading the file in blocks of read_size characters.
+    If the file contains a single JSON document instead of an array, yield that document.
+    The file is checked as json.load would: elements must be separated by commas, the array must be closed and nothing can follow it.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+    # What is expected next: 'start' (an array or a document), 'first' (an element or the end of the array), 'element' (an element after a comma),
+    # 'separator' (a comma or the end of the array) or 'end' (nothing else)
+    state = 'start'
+
+    while True:
+        # Skip whitespace, reading more data when the buffer runs out
+        while position < len(buffer) and buffer[position] in ' \t\r\n':
+            position += 1
+        if position == len(buffer):
+            if not eof:
+                buffer, position = f.read(read_size), 0
+                eof = not buffer
+                continue
+            if state == 'end':
+                return
+            raise json.JSONDecodeError("Expecting value" if state in ('start', 'element') else "Expecting ',' delimiter or ']'", buffer, position)
+
+        character = buffer[position]
+        if state == 'end':
+            raise json.JSONDecodeError("Extra data", buffer, position)
+        if state == 'start' and character == '[':
+            state, position = 'first', position + 1
+            continue
+        if state in ('first', 'separator') and character == ']':
+            state, position = 'end', position + 1
+            continue
+        if state == 'separator':
+            if character != ',':
+                raise json.JSONDecodeError("Expecting ',' delimiter", buffer, position)
+            state, position = 'element', position + 1
+            continue
+
+        # Decode the next element, reading more data if it is incomplete
+        try:
+            document, end = decoder.raw_decode(buffer, position)
+            # A number at the end of the buffer may go on in the next block (e.g. 3.5 of 3.5e3)
+            complete = eof or (end < len(buffer) and buffer[end] not in '0123456789+-.eE')
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            complete = False
+
+        if not complete:
+            more = f.read(max(read_size, len(buffer)))
+            eof = not more
+            buffer, position = buffer[position:] + more, 0
+            continue
+
+        yield document
+        position = end
+        state = 'end' if state == 'start' else 'separator'
+
+        # Drop the part of the buffer that has already been decoded
+        if position >= read_size:
+            buffer, position = buffer[position:], 0
+
+def readDocuments(json_file, skip_documents=0):
+    """
+    Yield the documents of a JSON file (a single document or an array of documents) or a JSON Lines file (.jsonl/.ndjson) one at a time,
+    after skipping the first skip_documents documents. The rows of Parquet and Arrow files are read in batches (see arrow_functions.readDocuments).
+    """
+    if json_file.endswith(arrow_functions.arrow_extensions):
+        yield from arrow_functions.readDocuments(json_file, skip_rows=skip_documents)
+        return
+    yield from islice(readJsonDocuments(json_file), skip_documents, None)
+
+def readJsonDocuments(json_file):
+    """
+    Yield the documents of a JSON file (a single document or an array of documents) or a JSON Lines file (.jsonl/.ndjson) one at a time.
+    JSON files up to max_decoded_bytes are decoded at once, larger ones are streamed so that only one element is decoded at a time.
+    """
+    if not json_file.endswith(('.jsonl', '.ndjson')) and os.path.getsize(json_file) <= max_decoded_bytes:
+        with open(json_file, 'rb') as f:
+            documents = loads(f.read())
+        yield from documents if isinstance(documents, list) else [documents]
+        return
+
+    with open(json_file, encoding='utf-8') as f:
+        if json_file.endswith(('.jsonl', '.ndjson')):
+            for line in f:
+                if line.strip():
+                    yield loads(line)
+        else:
+            yield from streamJsonArray(f)
+
+def runProgress(db, collection_name, run_id):
+    """
+    Read the progress of the files of an insert run from the processes of the run.
+    Returns, for every file, if it was finished, the number of documents read and the process that read them.
+    """
+    files = {}
+    for process in db['log_details'].find({"collection": collection_name, "parameters.run_id": run_id}):
+        progress = process.get("progress", {})
+        state = files.setdefault(process["parameters"]["json_file"], {"finished": False, "documents": 0, "process": None})
+        state["finished"] = state["finished"] or progress.get("file_finished", False)
+        if state["process"] is None or progress.get("documents", 0) > state["documents"]:
+            state["documents"], state["process"] = progress.get("documents", 0), process
+    return files
+
+def insertFile(operation, db, collection_name, json_file, name, method, chunk_size, log_backend='embedded', parameters=None, resume=None):
+    """
+    Insert the documents of one JSON or JSON Lines file into a specific collection from a database, in chunks of chunk_size documents.
+    The stable_ids of every chunk are looked up first, and only the documents that are not in the collection yet are inserted.
+    The process document is created before any document is inserted and stays running until the whole file is read, so an interrupted file can be resumed.
+    The documents carry their log when they are inserted and are written in adaptive bulk writes (see bulk_functions.BulkWriter).
+    The file records the documents read after every chunk, resume (the progress of the file, see runProgress) continues it after them.
+    Returns the number of documents inserted.
+    """
+    # Access the collection and its log storage
+    collection = db[collection_name]
+    storage = log_storage.getLogStorage(db, collection_name, log_backend)
+
+    report.message(f"Processing {json_file}")
+    metrics.startRecording()
+
+    # Insert metadata about the insert process before the documents, which carry its log_id, or continue the process of the resumed file
+    if resume and resume["process"]:
+        process_id = resume["process"]["_id"]
+        progress = resume["process"].get("progress", {})
+    else:
+        process_id = log_functions.insertLog(db, name, method, operation, collection_name, {**(parameters or {}), "json_file": json_file})
+        progress = {}
+    log_info = {
+        "log_id": str(process_id),
+        "operation": operation
+    }
+
+    # Stream the documents of the file in chunks, so only one chunk is in memory at a time
+    # Skip the documents read before the interruption, if the file is resumed
+    documents_read = progress.get("documents", 0)
+    documents = readDocuments(json_file, documents_read)
+    chunk_number = 0
+
+    # The documents are inserted in order, as insert_many does, and the log storage writes the entries of the inserted documents after every batch
+    writer = bulk_functions.BulkWriter(collection, storage, chunk_size, ordered=True)
+    writer.inserted_count = progress.get("inserted", 0)
+    progress_report = report.Progress(f"{operation} {json_file}")
+
+    while True:
+        with metrics.phase("read"):
+            documents_chunk = list(islice(documents, chunk_size))
+        if not documents_chunk:
+            break
+        chunk_number += 1
+        documents_read += len(documents_chunk)
+        metrics.count("documents_scanned", len(documents_chunk))
+
+        # Get the unique identifier for each document
+        unique_identifiers = [doc['stable_id'] for doc in documents_chunk]
+
+        # Find existing documents with the same identifiers
+        with metrics.phase("scan"):
+            existing_documents = collection.find({'stable_id': {'$in': unique_identifiers}}, {'stable_id': 1, '_id': 0})
+            existing_identifiers = {doc['stable_id'] for doc in existing_documents}
+
+        # Filter out documents that are already in the collection
+        chunk = [doc for doc in documents_chunk if doc['stable_id'] not in existing_identifiers]
+
+        # Add the log to the new documents and insert them
+        if chunk:
+            with metrics.phase("prepare"):
+                storage.logInsert(chunk, log_info)
+                for doc in chunk:
+                    writer.insert(doc, log_info)
+            writer.flush()
+            report.detail("Number of documents already existing in the collection with the same stable_id: {}", len(existing_identifiers))
+            report.detail("Inserted {} new documents from chunk {} of {}.", len(chunk), chunk_number, json_file)
+        else:
+            report.detail("No new documents to insert from chunk {} of {}.", chunk_number, json_file)
+
+        # The chunk is done, record how far the file has been read
+        log_functions.saveProgress(db, process_id, {"documents": documents_read, "inserted": writer.inserted_count})
+        progress_report.add("inserted", len(chunk))
+        progress_report.add("existing", len(existing_identifiers))
+
+    progress_report.finish()
+    if writer.inserted_count == 0:
+        log_functions.deleteLog(db, str(process_id))
+        report.message(f"No new documents to insert from {json_file}.")
+    else:
+        log_functions.saveProgress(db, process_id, {"file_finished": True})
+        log_functions.finishProcess(db, process_id)
+        metrics.saveMetrics(db, process_id)
+
+    # Track the documents of the file inserted in this run
+    return writer.inserted_count - progress.get("inserted", 0)
+
+def insertFileSinglePass(operation, db, collection_name, json_file, name, method, chunk_size, log_backend='embedded', parameters=None, resume=None):
+    """
+    Insert the documents of one JSON or JSON Lines file in a single pass, in chunks of chunk_size documents.
+    The process document is created first and the log is built into the documents before they are inserted, so every document is written once.
+    Documents whose stable_id already exists are rejected by the unique index on stable_id instead of being looked up.
+    The documents are written in adaptive bulk writes (see bulk_functions.BulkWriter).
+    The file is a process that records the documents read after every write, resume (the progress of the file, see runProgress) continues it after them.
+    Returns the number of documents inserted.
+    """
+    # Access the collection and its log storage
+    collection = db[collection_name]
+    storage = log_storage.getLogStorage(db, collection_name, log_backend)
+
+    report.message(f"Processing {json_file}")
+    metrics.startRecording()
+
+    # Insert metadata about the insert process before the documents, which carry its log_id, or continue the process of the resumed file
+    if resume and resume["process"]:
+        process_id = resume["process"]["_id"]
+        progress = resume["process"].get("progress", {})
+    else:
+        process_id = log_functions.insertLog(db, name, method, operation, collection_name, {**(parameters or {}), "json_file": json_file})
+        progress = {}
+    log_info = {
+        "log_id": str(process_id),
+        "operation": operation
+    }
+
+    # Stream the documents of the file in chunks, so only one chunk is in memory at a time
+    documents_read = progress.get("documents", 0)
+    documents = readDocuments(json_file, documents_read)
+    chunk_number = 0
+
+    # Duplicates are counted as existing documents, and the log storage writes the entries of the inserted documents after every batch
+    writer = bulk_functions.BulkWriter(collection, storage, chunk_size, ignore_duplicates=True, checkpoint=lambda documents_written: log_functions.saveProgress(db, process_id, {"documents": documents_written, "inserted": writer.inserted_count}))
+    writer.inserted_count = progress.get("inserted", 0)
+    progress_report = report.Progress(f"{operation} {json_file}")
+
+    while True:
+        with metrics.phase("read"):
+            chunk = list(islice(documents, chunk_size))
+        if not chunk:
+            break
+        chunk_number += 1
+        metrics.count("documents_scanned", len(chunk))
+
+        # Add the log to the documents and insert them, continuing after the duplicates
+        inserted_before, duplicates_before = writer.inserted_count, writer.duplicate_count
+        with metrics.phase("prepare"):
+            storage.logInsert(chunk, log_info)
+            for doc in chunk:
+                documents_read += 1
+                writer.insert(doc, log_info, documents_read)
+        writer.flush()
+
+        inserted_documents = writer.inserted_count - inserted_before
+        rejected_documents = writer.duplicate_count - duplicates_before
+
+        if inserted_documents:
+            report.detail("Number of documents already existing in the collection with the same stable_id: {}", rejected_documents)
+            report.detail("Inserted {} new documents from chunk {} of {}.", inserted_documents, chunk_number, json_file)
+        else:
+            report.detail("No new documents to insert from chunk {} of {}.", chunk_number, json_file)
+        progress_report.add("inserted", inserted_documents)
+        progress_report.add("existing", rejected_documents)
+
+    progress_report.finish()
+    if writer.inserted_count == 0:
+        log_functions.deleteLog(db, str(process_id))
+        report.message(f"No new documents to insert from {json_file}.")
+    else:
+        log_functions.saveProgress(db, process_id, {"file_finished": True})
+        log_functions.finishProcess(db, process_id)
+        metrics.saveMetrics(db, process_id)
+
+    # Track the documents of the file inserted in this run
+    return writer.inserted_count - progress.get("inserted", 0)
+
+def insertFileWorker(arguments):
+    """
+    Insert one file from a worker process using the connection of the worker.
+    """
+    operation, collection_name, json_file, name, method, chunk_size, log_backend, insert_mode, parameters, resume = arguments
+    insert_function = insertFileSinglePass if insert_mode == 'single_pass' else insertFile
+    return insert_function(operation, connection.worker_db, collection_name, json_file, name, method, chunk_size, log_backend, parameters, resume)
+
+def insertDocuments(operation, db, collection_name, json_documents, name, method, workers=1, log_backend='embedded', insert_mode='checked', resume=None):
     """
     Insert one or multiple documents into a specific collection from a database.
     The collection will be created if it doesn't exist.
     Supports inserting from a single file or multiple files in a directory.
+    Files can contain a single JSON document, a JSON array of documents or one document per line (.jsonl/.ndjson); they are read as a stream, in chunks of chunk_size documents.
+    Parquet and Arrow files (with pyarrow) have one document per row, their struct columns are embedded documents.
+    With more than one worker, the files of a directory are inserted in parallel by a pool of processes.
+    With the 'single_pass' insert mode the log is built into the documents before inserting them and duplicates are rejected by the unique index on stable_id (see insertFileSinglePass).
     If there is already a document in the collection that matches the stable_id of a document, the function does not insert the duplicate document into the collection.
+    The processes of an insert share a run_id and record their progress, resume (any process document of the run) skips the files finished and the documents already read.
     """
 
     total_inserted_documents = 0  # Counter for tracking total inserted documents
@@ -31,85 +331,54 @@ def insertDocuments(operation, db, collection_name, json_documents, name, method
         # Check if the path is a file or a directory
         if os.path.isfile(json_documents):
             json_files = [json_documents]  # Single file, put it in a list
-            print("There is 1 file to process.")
+            report.message("There is 1 file to process.")
         elif os.path.isdir(json_documents):
-            # List all JSON files in the directory
-            json_files = [os.path.join(json_documents, f) for f in os.listdir(json_documents) if os.path.isfile(os.path.join(json_documents, f)) and f.endswith('.json')]
+            # List all JSON, Parquet and Arrow files in the directory
+            json_files = [os.path.join(json_documents, f) for f in os.listdir(json_documents) if os.path.isfile(os.path.join(json_documents, f)) and f.endswith(json_extensions + arrow_functions.arrow_extensions)]
             json_files = sorted(json_files, key=lambda s: [int(text) if text.isdigit() else text.lower() for text in re.split('([0-9]+)', s)])
-            print(f"There is/are {len(json_files)} file(s) to process.")
-
-        # Access the collection
-        collection = db[collection_name]
-        print(f"Inserting file(s) into {collection_name} collection")     
-
-
-        # Begin loop for each JSON file
-        for json_file in json_files:
-            print(f"Processing {json_file}")
+            report.message(f"There is/are {len(json_files)} file(s) to process.")
 
-            # Read the JSON file
-            with open(json_file) as f:
-                data = json.load(f)
+        # Parquet and Arrow files can only be read with pyarrow
+        json_files = [json_file for json_file in json_files if not json_file.endswith(arrow_functions.arrow_extensions) or arrow_functions.checkPyarrow(json_file)]
 
-            # Determine if data is a single document or a list of documents
-            if isinstance(data, list):
-                documents = data
-            else:
-                documents = [data]
-
-            # Get the unique identifier for each document
-            unique_identifiers = [doc['stable_id'] for doc in documents]
-
-            # Find existing documents with the same identifiers
-            existing_documents = collection.find({'stable_id': {'$in': unique_identifiers}})
-            existing_identifiers = {doc['stable_id'] for doc in existing_documents}
+        report.message(f"Inserting file(s) into {collection_name} collection")
 
-            # Filter out documents that are already in the collection
-            new_documents = [doc for doc in documents if doc['stable_id'] not in existing_identifiers]
+        # The single pass insert relies on the unique index on stable_id to reject duplicates
+        if insert_mode == 'single_pass':
+            stable_id_index = index_functions.findIndex(db[collection_name], [("stable_id", 1)])
+            if not stable_id_index or not stable_id_index.get("unique"):
+                report.warning("The single pass insert needs a unique index on stable_id, run the ensure_indexes operation to create it. Checking the stable_ids before inserting instead.")
+                insert_mode = 'checked'
 
-            # Split the new documents into chunks
-            if new_documents:
-                # Insert documents in chunks
-                for i in range(0, len(new_documents), chunk_size):
-                    chunk = new_documents[i:i + chunk_size]
+        # The dedup of every chunk looks up the stable_ids
+        if insert_mode == 'checked':
+            index_functions.reportMissingIndexes(db[collection_name], ["stable_id"])
 
-                    result = collection.insert_many(chunk)
-                    inserted_ids = result.inserted_ids
+        # Continue the resumed run from the progress of its files
+        run_id = resume["parameters"]["run_id"] if resume else str(ObjectId())
+        parameters = {"json_documents": json_documents, "insert_mode": insert_mode, "workers": workers, "log_backend": log_backend, "run_id": run_id}
+        files_progress = runProgress(db, collection_name, run_id) if resume else {}
+        if resume:
+            json_files = [json_file for json_file in json_files if not files_progress.get(json_file, {}).get("finished")]
+            report.message(f"Resuming the insert, {len(json_files)} file(s) left to process.")
 
+        if workers > 1 and len(json_files) > 1:
+            # Spread the files across a pool of processes, each with its own MongoDB connection
+            report.message(f"Processing files with {min(workers, len(json_files))} workers.")
+            with Pool(min(workers, len(json_files)), initializer=connection.initWorker, initargs=(db.name,)) as pool:
+                arguments = [(operation, collection_name, json_file, name, method, chunk_size, log_backend, insert_mode, parameters, files_progress.get(json_file)) for json_file in json_files]
+                for inserted_documents in pool.imap_unordered(insertFileWorker, arguments):
                     # Track total inserted documents across files
-                    total_inserted_documents += len(inserted_ids)
-
-                    if inserted_ids:
-                        # Get the ObjectId of the inserted process document
-                        process_id = log_functions.insertLog(db, name, method, operation, collection_name)
-
-                        if process_id:
-                            # Prepare bulk update operations to add the log field to the inserted documents
-                            log_info = {
-                                "log_id": str(process_id),
-                                "operation": operation
-                            }
-                            bulk_updates = [
-                                UpdateOne({"_id": doc_id}, {"$set": {"log": [log_info]}})
-                                for doc_id in inserted_ids
-                            ]
-
-                            # Perform bulk update operations
-                            if bulk_updates:
-                                collection.bulk_write(bulk_updates)
-
-                            print(f"Number of documents already existing in the collection with the same stable_id: {len(existing_identifiers)}")
-                            print(f"Inserted {len(inserted_ids)} new documents from chunk {i // chunk_size + 1} of {json_file}.")
-                            print(f"Log information generated and added to the documents.")
-                        else:
-                            print("Log details were not generated.")
-                    else:
-                        print(f"No new documents to insert from chunk {i // chunk_size + 1} of {json_file}.")
-            else:
-                print(f"No new documents to insert from {json_file}.")
+                    total_inserted_documents += inserted_documents
+        else:
+            # Begin loop for each JSON file
+            insert_function = insertFileSinglePass if insert_mode == 'single_pass' else insertFile
+            for json_file in json_files:
+                # Track total inserted documents across files
+                total_inserted_documents += insert_function(operation, db, collection_name, json_file, name, method, chunk_size, log_backend, parameters, files_progress.get(json_file))
 
         # Print the total number of inserted documents at the end
-        print(f"Total number of documents inserted: {total_inserted_documents}")
+        report.message(f"Total number of documents inserted: {total_inserted_documents}")
 
     else:
-        print(f'{json_documents} file or directory does not exist.')
\ No newline at end of file
+        report.warning(f'{json_documents} file or directory does not exist.')
\ No newline at end of file
@@ -10,12 +10,15 @@ __status__ = "development"
 
 
 # Import Packages
-from datetime import datetime
+import hashlib
+from collections.abc import Mapping
+from datetime import datetime, timezone
 from bson.objectid import ObjectId
 
-def insertLog(db, name, method, operation, collection_name):
+def insertLog(db, name, method, operation, collection_name, parameters=None):
     """
     Generate a log document with information about the process inside the log_details collection.
+    With parameters, the process can be resumed: they are stored with its status and progress (see saveProgress).
     """
     # Insert metadata into the 'meta' collection
     log_collection = db['log_details']
@@ -25,27 +28,74 @@ def insertLog(db, name, method, operation, collection_name):
         "operation" : operation,
         "collection": collection_name,
         "method": method, 
-        "date": datetime.now().strftime('%Y-%m-%dT%H:%M:%S+00:00')
+        "date": datetime.now().strftime('%Y-%m-%dT%H:%M:%S+00:00'),
+        "started": datetime.now(timezone.utc)  # Start time in UTC with millisecond precision, the order of the processes (see history.laterProcesses)
     }
+    if parameters is not None:
+        process_info["parameters"] = parameters
+        process_info["status"] = "running"
+        process_info["progress"] = {}
     log_result = log_collection.insert_one(process_info)
 
     return log_result.inserted_id
 
-def updateLog(previous_document, process_id, operation, update_field, previous_value, new_value):
+def saveProgress(db, process_id, progress):
     """
-    Generate/update log information inside of every document.
+    Record the progress of a process in its log document, so it can be resumed from that point if it's interrupted.
     """
+    db['log_details'].update_one({"_id": ObjectId(process_id)}, {"$set": {f"progress.{key}": value for key, value in progress.items()}})
 
-    # If there's no previous document (meaning the log doesn't exist yet), start with an empty log
-    existing_log = [] if previous_document is None else previous_document.get("log", [])
+def finishProcess(db, process_id):
+    """
+    Mark a process as finished in its log document, it has nothing left to resume.
+    """
+    db['log_details'].update_one({"_id": ObjectId(process_id)}, {"$set": {"status": "finished"}})
+
+def canonicalKey(value):
+    """
+    Return a hashable key of a BSON value that is equal for equal values, including embedded documents and arrays.
+    Embedded documents are keyed by their sorted fields, so the order of the fields doesn't matter.
+    Booleans are keyed with their type, BSON stores them apart from the numbers Python finds equal to them (True == 1).
+    """
+    if isinstance(value, Mapping):
+        return ("document", tuple(sorted((key, canonicalKey(element)) for key, element in value.items())))
+    if isinstance(value, list):
+        return ("array", tuple(canonicalKey(element) for element in value))
+    if isinstance(value, bool):
+        return ("bool", value)
+    try:
+        hash(value)
+        return value
+    except TypeError:
+        return ("value", repr(value))
+
+def sameValue(value, other_value):
+    """
+    Check if two BSON values are equal, telling booleans apart from numbers (see canonicalKey).
+    """
+    return value == other_value and canonicalKey(value) == canonicalKey(other_value)
 
-    # Normalize values to lists for proper comparison
-    prev_list = previous_value if isinstance(previous_value, list) else [previous_value] if previous_value is not None and previous_value != "Non-existing" else []
-    new_list = new_value if isinstance(new_value, list) else [new_value] if new_value is not None else []
+def valueKeys(value):
+    """
+    Normalize a value to a list and key its distinct elements by canonicalKey, keeping their order.
+    None and "Non-existing" have no elements.
+    """
+    value_list = value if isinstance(value, list) else [value] if value is not None and value != "Non-existing" else []
+    return {canonicalKey(element): element for element in value_list}
+
+def logEntry(process_id, operation, update_field, previous_value, new_value, new_keys=None):
+    """
+    Generate the log entry describing the change of a field in one document.
+    new_keys are the valueKeys of new_value, operations writing the same value to many documents compute them only once.
+    """
+    # Normalize values to lists of distinct elements for proper comparison
+    prev_keys = valueKeys(previous_value)
+    if new_keys is None:
+        new_keys = valueKeys(new_value)
 
     # Compute added and removed values
-    added_values = list(set(new_list) - set(prev_list))
-    removed_values = list(set(prev_list) - set(new_list))
+    added_values = [element for key, element in new_keys.items() if key not in prev_keys]
+    removed_values = [element for key, element in prev_keys.items() if key not in new_keys]
 
     # Prepare log entry
     new_log = {
@@ -64,17 +114,69 @@ def updateLog(previous_document, process_id, operation, update_field, previous_v
         if removed_values:  
             new_log["changed_values"]["removed"] = removed_values  
 
+    return new_log
 
-    # Merge the new metadata with the existing log
-    existing_log.insert(0, new_log)
+def snapshotDue(document_id, log_id, snapshot_interval):
+    """
+    Decide if the log entry of a document gets a snapshot of the full value: about one entry of every snapshot_interval entries does.
+    The choice is spread by a hash of the document and the process, so the history of the document doesn't have to be read.
+    """
+    if not snapshot_interval:
+        return False
+    digest = hashlib.md5(f"{log_id}:{document_id}".encode()).digest()
+    return int.from_bytes(digest[:4], "big") % snapshot_interval == 0
+
+def addSnapshot(log_entry, document_id, update, snapshot_interval):
+    """
+    Add the full value written by the update to the log entry of a field when a snapshot is due, so restores can start from it.
+    """
+    modified_field = log_entry.get("modified_field")
+    new_values = update.get("$set", {})
+    if modified_field in new_values and snapshotDue(document_id, log_entry["log_id"], snapshot_interval):
+        log_entry["snapshot"] = new_values[modified_field]
+    return log_entry
+
+def logEntryExpression(process_id, operation, update_field, previous_value, new_value):
+    """
+    Generate the aggregation expression that computes the log entry of logEntry on the server.
+    previous_value is an aggregation expression (e.g. "$field") and new_value the value written by the operation.
+    """
+    # Normalize values to lists for proper comparison, as logEntry does
+    previous = {"$ifNull": [previous_value, None]}
+    missing_previous = {"$in": [previous, [None, "Non-existing"]]}
+    prev_list = {"$cond": [{"$isArray": previous}, previous, {"$cond": [missing_previous, [], [previous]]}]}
+    new_list = {"$literal": new_value if isinstance(new_value, list) else [new_value] if new_value is not None else []}
 
-    return existing_log
+    # Compute added and removed values
+    added_values = {"$setDifference": [new_list, prev_list]}
+    removed_values = {"$setDifference": [prev_list, new_list]}
+
+    # Prepare log entry, including changed values only if there's a difference
+    return {
+        "log_id": {"$literal": str(process_id)},
+        "operation": {"$literal": operation},
+        "modified_field": {"$literal": update_field},
+        "changed_values": {"$cond": [missing_previous, "$$REMOVE", {
+            "added": {"$cond": [{"$gt": [{"$size": added_values}, 0]}, added_values, "$$REMOVE"]},
+            "removed": {"$cond": [{"$gt": [{"$size": removed_values}, 0]}, removed_values, "$$REMOVE"]}
+        }]}
+    }
+
+def updateLogStage(process_id, operation, update_field, previous_value, new_value):
+    """
+    Generate the aggregation pipeline stage that prepends the log entry of logEntry to the log of every document, computed on the server.
+    """
+    new_log = logEntryExpression(process_id, operation, update_field, previous_value, new_value)
+
+    # Merge the new metadata with the existing log
+    return {"$set": {"log": {"$concatArrays": [[new_log], {"$ifNull": ["$log", []]}]}}}
 
 def deleteLog(db, process_id):
     """
-    Delete the log document inside the log_details collection based on process_id.
+    Delete the log document inside the log_details collection based on process_id, and its entries in the log_entries journal if any.
     """
     log_collection = db["log_details"]  # Assuming "meta" is the name of your metadata collection
     result = log_collection.delete_one({"_id": ObjectId(process_id)})
+    db["log_entries"].delete_many({"log_id": str(process_id)})
     
 
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+
+"""log_storage.py  :  Store and read the log entries of the documents """
+
+__author__ = "Marta Huertas"
+__version__ = "0.1"
+__maintainer__ = "Aldar Cabrelles"
+__email__ = "aldar.cabrelles@crg.eu"
+__status__ = "development"
+
+# Import Packages
+from datetime import datetime, timezone
+from itertools import islice
+from pymongo import DESCENDING
+from . import index_functions, log_functions, scan_functions
+
+# Log storage backends:
+# - embedded: the entries are kept in the log array of every document (newest first).
+# - journal: every entry is a document of the log_entries collection, keyed by collection, document _id, log_id and field.
+#   Documents are not rewritten to add log entries, and their size doesn't grow with their history.
+log_backends = ['embedded', 'journal']
+
+def getLogStorage(db, collection_name, backend='embedded', snapshot_interval=0):
+    """
+    Return the log storage of a collection for the chosen backend.
+    With snapshot_interval, about one log entry of a field every snapshot_interval entries stores the full value of the field (see log_functions.addSnapshot).
+    """
+    if backend == 'journal':
+        return JournalLog(db, collection_name, snapshot_interval=snapshot_interval)
+    return EmbeddedLog(db, collection_name, snapshot_interval)
+
+class EmbeddedLog:
+    """
+    Log entries stored in the log array of every document.
+    """
+
+    def __init__(self, db, collection_name, snapshot_interval=0):
+        self.db = db
+        self.collection = db[collection_name]
+        self.snapshot_interval = snapshot_interval
+
+    def ensureIndexes(self):
+        """
+        Check that the collection has an index on log.log_id and create it if it's missing.
+        """
+        index_functions.ensureIndex(self.collection, [("log.log_id", 1)])
+
+    def logUpdate(self, document, log_entry, update):
+        """
+        Add the log entry to the update of the document: the entry is pushed at the start of the log of the document,
+        so the existing log doesn't have to be read or sent back.
+        """
+        return self.logUpdates(document, [log_entry], update)
+
+    def logUpdates(self, document, log_entries, update):
+        """
+        Add the log entries of several fields changed by the same update to it, pushed together at the start of the log.
+        """
+        log_entries = [log_functions.addSnapshot(log_entry, document["_id"], update, self.snapshot_interval) for log_entry in log_entries]
+        update["$push"] = {"log": {"$each": log_entries, "$position": 0}}
+        return update
+
+    def logInsert(self, documents, log_entry):
+        """
+        Add the log entry to new documents before they are inserted.
+        """
+        for document in documents:
+            document["log"] = [log_entry]
+
+    def insertedEntries(self, document_ids, log_entry):
+        """
+        Return the entries to write for documents that were inserted. Their log was added before the insertion, there are none.
+        """
+        return []
+
+    def takePending(self):
+        """
+        Return the pending log entries and forget them. The entries travel with the document updates, there are none.
+        """
+        return []
+
+    def writeEntries(self, entries):
+        """
+        Write log entries taken with takePending. There are none.
+        """
+        pass
+
+    def flush(self):
+        """
+        Write the pending log entries. The entries travel with the document updates, there's nothing to do.
+        """
+        pass
+
+    def logPipeline(self, query, process_id, operation, update_field, previous_value, new_value):
+        """
+        Return the pipeline stages that prepend the log entry to the documents matching the query in a pipeline update.
+        """
+        return [log_functions.updateLogStage(process_id, operation, update_field, previous_value, new_value)]
+
+    def documentLog(self, document):
+        """
+        Return the log entries of a document, newest first.
+        """
+        return document.get("log", [])
+
+    def documentLogs(self, documents):
+        """
+        Return the log entries of several documents read with their log, newest first, by document _id.
+        """
+        return {document["_id"]: self.documentLog(document) for document in documents}
+
+    def modifiedFields(self, log_id):
+        """
+        Return the fields modified in the documents of the collection by log_id.
+        """
+        return [entry["_id"] for entry in self.collection.aggregate([
+            {"$match": {"log.log_id": log_id}},
+            {"$unwind": "$log"},
+            {"$match": {"log.log_id": log_id}},
+            {"$group": {"_id": "$log.modified_field"}}
+        ]) if entry["_id"]]
+
+    def countLogged(self, log_id, after_id=None):
+        """
+        Count the documents modified by log_id, after after_id, through the index on log.log_id.
+        """
+        query = {"log.log_id": log_id}
+        if after_id is not None:
+            query["_id"] = {"$gt": after_id}
+        return self.collection.count_documents(query)
+
+    def findLogged(self, log_id, fields, after_id=None):
+        """
+        Yield the documents modified by log_id, with the given fields, together with their log entries.
+        The documents are yielded in _id order, after_id skips the documents up to that _id.
+        """
+        query = {"log.log_id": log_id}
+        if after_id is not None:
+            query["_id"] = {"$gt": after_id}
+        for document in scan_functions.scanDocuments(self.collection, query, fields + ["log"]).sort("_id", 1):
+            yield document, self.documentLog(document)
+
+class JournalLog:
+    """
+    Log entries stored as documents of the log_entries collection.
+    """
+
+    def __init__(self, db, collection_name, batch_size=1000, snapshot_interval=0):
+        self.db = db
+        self.collection = db[collection_name]
+        self.journal = db["log_entries"]
+        self.batch_size = batch_size
+        self.snapshot_interval = snapshot_interval
+        self.pending = []
+
+    def ensureIndexes(self):
+        """
+        Create the indexes of the journal if they're missing: entries of a document in order, and entries of a process by field.
+        """
+        for keys in index_functions.journal_indexes:
+            index_functions.ensureIndex(self.journal, keys)
+
+    def journalEntry(self, document_id, log_entry):
+        """
+        Generate the journal document of a log entry.
+        The date is in UTC, as the $$NOW of the entries written on the server (see logPipeline), so the entries of both sort in the order they were written.
+        """
+        return {"collection": self.collection.name, "document_id": document_id, **log_entry, "date": datetime.now(timezone.utc)}
+
+    def logUpdate(self, document, log_entry, update):
+        """
+        Queue the log entry of the document in the journal, the update of the document is not changed.
+        """
+        return self.logUpdates(document, [log_entry], update)
+
+    def logUpdates(self, document, log_entries, update):
+        """
+        Queue the log entries of several fields changed by the same update in the journal.
+        """
+        for log_entry in log_entries:
+            log_entry = log_functions.addSnapshot(log_entry, document["_id"], update, self.snapshot_interval)
+            self.pending.append(self.journalEntry(document["_id"], log_entry))
+        return update
+
+    def logInsert(self, documents, log_entry):
+        """
+        Prepare new documents before they are inserted. Their entries are only written once they are inserted.
+        """
+        pass
+
+    def insertedEntries(self, document_ids, log_entry):
+        """
+        Return the journal entries of documents that were inserted.
+        """
+        return [self.journalEntry(document_id, log_entry) for document_id in document_ids]
+
+    def takePending(self):
+        """
+        Return the pending log entries and forget them, so they can be written with the batch of updates they belong to.
+        """
+        pending, self.pending = self.pending, []
+        return pending
+
+    def writeEntries(self, entries):
+        """
+        Write log entries taken with takePending to the journal.
+        """
+        if entries:
+            self.journal.insert_many(entries, ordered=True)
+
+    def flush(self):
+        """
+        Write the pending log entries to the journal.
+        """
+        self.writeEntries(self.takePending())
+
+    def logPipeline(self, query, process_id, operation, update_field, previous_value, new_value):
+        """
+        Write the log entries of the documents matching the query to the journal on the server, before the documents are updated.
+        No stage has to be added to the pipeline update of the documents.
+        """
+        new_log = log_functions.logEntryExpression(process_id, operation, update_field, previous_value, new_value)
+        self.collection.aggregate([
+            {"$match": query},
+            {"$project": {
+                "_id": {"$concat": [str(process_id), ":", {"$toString": "$_id"}]},
+                "collection": {"$literal": self.collection.name},
+                "document_id": "$_id",
+                **new_log,
+                "date": "$$NOW"
+            }},
+            {"$merge": {"into": self.journal.name, "whenMatched": "keepExisting", "whenNotMatched": "insert"}}
+        ])
+        return []
+
+    def documentLog(self, document):
+        """
+        Return the log entries of a document, newest first.
+        """
+        return list(self.journal.find({"collection": self.collection.name, "document_id": document["_id"]}).sort([("date", DESCENDING), ("_id", DESCENDING)]))
+
+    def documentLogs(self, documents):
+        """
+        Return the log entries of several documents with a single query, newest first, by document _id.
+        """
+        logs = {document["_id"]: [] for document in documents}
+        for entry in self.journal.find({"collection": self.collection.name, "document_id": {"$in": list(logs)}}).sort([("date", DESCENDING), ("_id", DESCENDING)]):
+            logs[entry["document_id"]].append(entry)
+        return logs
+
+    def modifiedFields(self, log_id):
+        """
+        Return the fields modified in the documents of the collection by log_id.
+        """
+        return [field for field in self.journal.distinct("modified_field", {"log_id": log_id, "collection": self.collection.name}) if field]
+
+    def countLogged(self, log_id, after_id=None):
+        """
+        Count the documents modified by log_id in the collection after the document after_id.
+        A document has one entry for every field the process changed in it, they are counted once.
+        """
+        query = {"log_id": log_id, "collection": self.collection.name}
+        if after_id is not None:
+            query["document_id"] = {"$gt": after_id}
+        return next(self.journal.aggregate([{"$match": query}, {"$group": {"_id": "$document_id"}}, {"$count": "documents"}]), {}).get("documents", 0)
+
+    def findLogged(self, log_id, fields, after_id=None):
+        """
+        Yield the documents modified by log_id, with the given fields, together with their log entries.
+        The documents are yielded in _id order, after_id skips the documents up to that _id.
+        The documents and their entries are read in batches of batch_size documents.
+        """
+        query = {"log_id": log_id, "collection": self.collection.name}
+        if after_id is not None:
+            query["document_id"] = {"$gt": after_id}
+        document_ids = (entry["document_id"] for entry in self.journal.find(query, {"document_id": 1}).sort("document_id", 1))
+        seen_ids = set()
+        while True:
+            batch = list(dict.fromkeys(islice(document_ids, self.batch_size)))
+            if not batch:
+                break
+
+            # A document can have several entries with the same log_id, yield it only once
+            batch = [document_id for document_id in batch if document_id not in seen_ids]
+            seen_ids.update(batch)
+
+            # Read the entries of the whole batch at once, newest first
+            logs = {document_id: [] for document_id in batch}
+            for entry in self.journal.find({"collection": self.collection.name, "document_id": {"$in": batch}}).sort([("date", DESCENDING), ("_id", DESCENDING)]):
+                logs[entry["document_id"]].append(entry)
+
+            for document in scan_functions.scanDocuments(self.collection, {"_id": {"$in": batch}}, fields).sort("_id", 1):
+                yield document, logs[document["_id"]]
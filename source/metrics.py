@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+
+"""metrics.py  :  Record the performance of the operations and save it with their process """
+
+__author__ = "Marta Huertas"
+__version__ = "0.1"
+__maintainer__ = "Aldar Cabrelles"
+__email__ = "aldar.cabrelles@crg.eu"
+__status__ = "development"
+
+# Import Packages
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+import bson
+from bson.objectid import ObjectId
+from pymongo import monitoring
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the peak memory is not recorded
+    resource = None
+
+# Export of the metrics of every process besides log_details: '' (none), 'json' (one JSON line per process appended to export_file)
+# or 'prometheus' (textfile with the metrics of the last process, for the textfile collector of the node exporter)
+export_formats = ['', 'json', 'prometheus']
+export_format = ''
+export_file = ''
+
+# Measure the bytes read by encoding the replies of MongoDB again in the command listener. It doubles the BSON work of the reads, so it's only on when the metrics are exported
+measure_replies = False
+
+# Recorder of the operation running in this process, the MongoDB commands are attributed to it
+current = None
+
+class Recorder:
+    """
+    Metrics of a run of an operation:
+    - Time per phase: read (reading input files), scan (waiting for documents), diff (comparing values and preparing the changes),
+      prepare (preparing new documents), write (bulk writes) and wait (waiting for the writes in flight). Nested phases are not counted in the phase around them, and writes
+      in background threads overlap the other phases.
+    - Documents scanned, modified and inserted, bulk write batches and their round-trip times.
+    - MongoDB commands sent, counted by the command listener, and encoded bytes of the bulk writes, as measured by the BulkWriter.
+      The encoded bytes of the replies are only measured with measure_replies.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.phases = {}
+        self.counters = {"documents_scanned": 0, "documents_modified": 0, "documents_inserted": 0, "commands": 0, "bytes_written": 0}
+        if measure_replies:
+            self.counters["bytes_read"] = 0
+        self.batch_seconds = []
+
+    def add(self, counter, value):
+        """
+        Add a value to a counter, from any thread.
+        """
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def addTime(self, phase, seconds):
+        """
+        Add time to a phase and take it out of the phase around it in the same thread.
+        """
+        stack = self.local.__dict__.setdefault("stack", [])
+        if stack:
+            stack[-1] += seconds
+        with self.lock:
+            self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time a phase of the operation.
+        """
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(0.0)  # Time of the phases nested in this one
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.addTime(name, elapsed - stack.pop())
+
+    def batchWritten(self, seconds, modified, inserted):
+        """
+        Record a bulk write batch, its round-trip time and the documents it modified and inserted.
+        """
+        with self.lock:
+            self.batch_seconds.append(seconds)
+            self.counters["documents_modified"] += modified
+            self.counters["documents_inserted"] += inserted
+
+    def summary(self):
+        """
+        Return the metrics recorded so far as a document.
+        """
+        with self.lock:
+            batch_seconds = sorted(self.batch_seconds)
+            metrics = {
+                "seconds": round(time.perf_counter() - self.start, 3),
+                "phases": {phase: round(seconds, 3) for phase, seconds in self.phases.items()},
+                **self.counters,
+                "batches": len(batch_seconds)
+            }
+        if batch_seconds:
+            # Nearest-rank percentiles of the round-trip times of the batches
+            metrics["batch_seconds"] = {f"p{percentile}": round(batch_seconds[max(0, -(-len(batch_seconds) * percentile // 100) - 1)], 4) for percentile in [50, 90, 99]}
+            metrics["batch_seconds"]["max"] = round(batch_seconds[-1], 4)
+        if resource:
+            # ru_maxrss is in kilobytes on Linux
+            metrics["peak_rss_mb"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        return metrics
+
+class CommandMetrics(monitoring.CommandListener):
+    """
+    Count the commands sent to MongoDB for the current recorder, and the encoded size of their replies with measure_replies.
+    The commands are not encoded again, the bytes written are the sizes the BulkWriter already computed.
+    """
+
+    def started(self, event):
+        if current:
+            current.add("commands", 1)
+
+    def succeeded(self, event):
+        if current and measure_replies:
+            current.add("bytes_read", len(bson.encode(event.reply)))
+
+    def failed(self, event):
+        pass
+
+# Listener to register in the MongoClients (see connection.connectDatabase)
+listener = CommandMetrics()
+
+def startRecording():
+    """
+    Start recording the metrics of an operation, replacing the recorder of the previous one.
+    """
+    global current
+    current = Recorder()
+    return current
+
+def phase(name):
+    """
+    Time a phase of the current operation, if its metrics are being recorded.
+    """
+    return current.phase(name) if current else nullcontext()
+
+def count(counter, value):
+    """
+    Add a value to a counter of the current operation, if its metrics are being recorded.
+    """
+    if current:
+        current.add(counter, value)
+
+def scanned(documents, phase="diff"):
+    """
+    Iterate over scanned documents, counting them. The time spent waiting for them is counted in the scan phase,
+    and the time spent processing each of them, apart from the phases nested in it (e.g. writes), in the given phase.
+    """
+    if not current:
+        yield from documents
+        return
+
+    recorder = current
+    stack = recorder.local.__dict__.setdefault("stack", [])
+    documents = iter(documents)
+    while True:
+        start = time.perf_counter()
+        document = next(documents, None)
+        recorder.addTime("scan", time.perf_counter() - start)
+        if document is None:
+            break
+        recorder.counters["documents_scanned"] += 1
+
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield document
+        finally:
+            elapsed = time.perf_counter() - start
+            recorder.addTime(phase, elapsed - stack.pop())
+
+def saveMetrics(db, process_id):
+    """
+    Save the metrics of the current operation in the log document of its process, and export them if export_format is set.
+    """
+    if not current:
+        return
+    metrics = current.summary()
+    db['log_details'].update_one({"_id": ObjectId(process_id)}, {"$set": {"metrics": metrics}})
+
+    if export_format:
+        process = db['log_details'].find_one({"_id": ObjectId(process_id)}, {"name": 1, "operation": 1, "collection": 1})
+        exportMetrics(process, metrics, export_format, export_file)
+
+def prometheusLines(process, metrics):
+    """
+    Format the metrics of a process in the Prometheus text format, labelled by operation, collection and name.
+    """
+    labels = f'operation="{process.get("operation", "")}",collection="{process.get("collection", "")}",name="{process.get("name", "")}"'
+    lines = [f'biomongo_process_info{{{labels},log_id="{process["_id"]}"}} 1']
+    for key, value in metrics.items():
+        if key == "phases":
+            lines += [f'biomongo_phase_seconds{{{labels},phase="{phase}"}} {seconds}' for phase, seconds in value.items()]
+        elif key == "batch_seconds":
+            lines += [f'biomongo_batch_seconds{{{labels},percentile="{percentile}"}} {seconds}' for percentile, seconds in value.items()]
+        else:
+            lines.append(f'biomongo_{"process_seconds" if key == "seconds" else key}{{{labels}}} {value}')
+    return lines
+
+def exportMetrics(process, metrics, export_format, export_file):
+    """
+    Export the metrics of a process as a JSON line appended to export_file, or as a Prometheus textfile replacing export_file.
+    """
+    if export_format == 'json':
+        record = {"log_id": str(process["_id"]), "name": process.get("name"), "operation": process.get("operation"),
+                  "collection": process.get("collection"), "date": datetime.now().isoformat(), "metrics": metrics}
+        with open(export_file, "a") as f:
+            f.write(json.dumps(record) + "\n")
+    elif export_format == 'prometheus':
+        # Write to a temporary file and rename it, so the collector never reads a partial file
+        temporary_file = f"{export_file}.{os.getpid()}.tmp"
+        with open(temporary_file, "w") as f:
+            f.write("\n".join(prometheusLines(process, metrics)) + "\n")
+        os.replace(temporary_file, export_file)
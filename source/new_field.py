@@ -10,55 +10,48 @@ __status__ = "development"
 
 
 # Import Packages
-from . import log_functions
-from pymongo import UpdateOne
+from . import log_functions, log_storage, scan_functions, metrics, report
 
-def addNullField(operation, db, collection_name, new_field, name, method):
+def addNullField(operation, db, collection_name, new_field, name, method, log_backend='embedded'):
     """
     Insert a new field with a null value in all documents in a specific collection from the database.
+    The field and the log entries are written on the server with a single pipeline update.
     """
     if collection_name not in db.list_collection_names():
-        print(f"There's no collection named {collection_name}.")
+        report.warning(f"There's no collection named {collection_name}.")
         return
 
-    # Access the collection
+    # Access the collection and its log storage
     collection = db[collection_name]
+    storage = log_storage.getLogStorage(db, collection_name, log_backend)
+    metrics.startRecording()
 
     # Check if the field exists in any document in the collection
-    if not collection.find_one({new_field: {"$exists": True}}):
+    if not scan_functions.fieldExists(collection, new_field):
         # Insert metadata about the update process in the collection log_details
         process_id = log_functions.insertLog(db, name, method, operation, collection_name)
         if not process_id:
-            print("Failed to create log for the update process.")
+            report.warning("Failed to create log for the update process.")
             return
 
         updates_made = 0
-        print(f"Adding field {new_field} to all documents in the {collection_name} collection.")
+        report.message(f"Adding field {new_field} to all documents in the {collection_name} collection.")
 
-        # Find all documents to update
-        previous_documents = collection.find({})
-
-        # Prepare bulk update operations
-        bulk_updates = []
-        for previous_document in previous_documents:
-            # Update the log field in the JSON document
-            updated_log = log_functions.updateLog(previous_document, process_id, operation, new_field, "Non-existing", None)
-
-            # Create the update operation
-            bulk_updates.append(
-                UpdateOne({"_id": previous_document["_id"]}, {"$set": {new_field: None, "log": updated_log}})
-            )
-
-        # Execute the bulk update operations
-        if bulk_updates:
-            result = collection.bulk_write(bulk_updates)
-            updates_made = result.modified_count
+        # Add the field and the log entry to all the documents on the server
+        with metrics.phase("write"):
+            result = collection.update_many({}, storage.logPipeline({}, process_id, operation, new_field, {"$literal": "Non-existing"}, None) + [
+                {"$set": {new_field: {"$literal": None}}}
+            ])
+        metrics.count("documents_scanned", result.matched_count)
+        metrics.count("documents_modified", result.modified_count)
+        updates_made = result.modified_count
 
         # If no updates were made, remove the log document
         if updates_made == 0:
             log_functions.deleteLog(db, str(process_id))
-            print("No changes were made.")
+            report.message("No changes were made.")
         else:
-            print(f"Field added successfully in {updates_made} documents.")
+            metrics.saveMetrics(db, process_id)
+            report.message(f"Field added successfully in {updates_made} documents.")
     else:
-        print(f"The field {new_field} already exists in at least one document in the collection.")
\ No newline at end of file
+        report.warning(f"The field {new_field} already exists in at least one document in the collection.")
\ No newline at end of file
@@ -8,8 +8,7 @@ __maintainer__ = "Aldar Cabrelles"
 __email__ = "aldar.cabrelles@crg.eu"
 __status__ = "development"
 
-from . import log_functions
-from pymongo import UpdateOne
+from . import log_functions, log_storage, scan_functions, metrics, report
 
 
 # CONSIDERATIONS:
@@ -25,55 +24,44 @@ def ask_user(prompt):
         elif response in ['no', 'n']:
             return False
         else:
-            print("Please answer 'yes' or 'no'.")
+            report.warning("Please answer 'yes' or 'no'.")
 
-def removeField(operation, db, collection_name, field_to_remove, name, method):
+def removeField(operation, db, collection_name, field_to_remove, name, method, log_backend='embedded'):
     """
     Remove a specific field in all the documents of a collection.
+    The field is removed and the log entries are written on the server with a single pipeline update.
     """
     # Confirm with the user before proceeding
     if not ask_user(f"Are you sure you want to remove the field '{field_to_remove}' from all documents in the {collection_name} collection?"):
-        print("Operation canceled.")
+        report.message("Operation canceled.")
         return
 
-    # Access the collection
+    # Access the collection and its log storage
     collection = db[collection_name]
+    storage = log_storage.getLogStorage(db, collection_name, log_backend)
+    metrics.startRecording()
 
     # Check if the field exists in at least one document in the collection
-    if collection.find_one({field_to_remove: {"$exists": True}}):
+    if scan_functions.fieldExists(collection, field_to_remove):
         # Insert metadata about the update process
         process_id = log_functions.insertLog(db, name, method, operation, collection_name)
         
-        # Prepare a list of bulk update operations
-        bulk_updates = []
-        previous_documents = collection.find({field_to_remove: {"$exists": True}})
-        
-        for previous_document in previous_documents:
-            # Get the previous value of the field
-            previous_value = previous_document.get(field_to_remove)
-
-            # Update the log field in the JSON document
-            updated_log = log_functions.updateLog(previous_document, process_id, operation, field_to_remove, previous_value, "Non-existing")
-
-            # Create the update operation
-            bulk_updates.append(UpdateOne(
-                {"_id": previous_document["_id"]},
-                {"$unset": {field_to_remove: ""}, "$set": {"log": updated_log}}
-            ))
+        # Remove the field and add the log entry with its previous value on the server
+        query = {field_to_remove: {"$exists": True}}
+        with metrics.phase("write"):
+            result = collection.update_many(query, storage.logPipeline(query, process_id, operation, field_to_remove, f"${field_to_remove}", "Non-existing") + [
+                {"$unset": field_to_remove}
+            ])
+        metrics.count("documents_scanned", result.matched_count)
+        metrics.count("documents_modified", result.modified_count)
+        updates_made = result.modified_count
 
-        # Execute the bulk update operations
-        if bulk_updates:
-            result = collection.bulk_write(bulk_updates)
-            updates_made = result.modified_count
-
-            if updates_made == 0:
-                log_functions.deleteLog(db, str(process_id))
-                print("No changes were made.")
-            else:
-                print(f'Field {field_to_remove} removed from {updates_made} documents.')
-        else:
+        if updates_made == 0:
             log_functions.deleteLog(db, str(process_id))
-            print("No changes were made.")
+            report.message("No changes were made.")
+        else:
+            metrics.saveMetrics(db, process_id)
+            report.message(f'Field {field_to_remove} removed from {updates_made} documents.')
     else:
-        print(f"The field {field_to_remove} doesn't exist in any document in the collection.")
+        report.warning(f"The field {field_to_remove} doesn't exist in any document in the collection.")
 
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""report.py  :  Report the progress and results of the operations """
+
+__author__ = "Marta Huertas"
+__version__ = "0.1"
+__maintainer__ = "Aldar Cabrelles"
+__email__ = "aldar.cabrelles@crg.eu"
+__status__ = "development"
+
+# Import Packages
+import gzip
+import os
+import time
+from datetime import timedelta
+
+# Verbosity levels: quiet only shows warnings and errors, normal adds the results and progress lines, detailed adds a line for every document
+quiet, normal, detailed = 0, 1, 2
+verbosity = normal
+progress_interval = 10  # Seconds between progress lines
+
+# Compressed file the line of every document is written to, whatever the verbosity (see openDetails)
+details_file = ''
+details = None
+
+def message(text, level=normal, file=None):
+    """
+    Show a message if the verbosity is at least level.
+    """
+    if verbosity >= level:
+        print(text, file=file)
+
+def warning(text):
+    """
+    Show a warning or error, whatever the verbosity.
+    """
+    print(text)
+
+def detail(text, *arguments):
+    """
+    Report the outcome for one document: written to the details file and shown with the detailed verbosity.
+    The text is only formatted with the arguments (str.format) if it's going to be written or shown.
+    """
+    if details is None and verbosity < detailed:
+        return
+    line = text.format(*arguments) if arguments else text
+    if details is not None:
+        details.write(line + "\n")
+    if verbosity >= detailed:
+        print(line)
+
+def openDetails(path):
+    """
+    Start writing the document lines to a gzip-compressed text file, appending to it if it exists.
+    """
+    global details, details_file
+    details_file = path
+    details = gzip.open(path, "at", encoding="utf-8")
+
+def closeDetails():
+    """
+    Finish writing the document lines.
+    """
+    global details
+    if details is not None:
+        details.close()
+        details = None
+
+def initWorker():
+    """
+    Write the document lines of a forked worker process to its own details file, next to the one of the parent process.
+    The file inherited from the parent is dropped without closing it, so the parent's buffered lines are not written twice.
+    """
+    global details
+    details = None
+    if details_file:
+        name, extension = (details_file[:-3], ".gz") if details_file.endswith(".gz") else (details_file, "")
+        openDetails(f"{name}.worker{os.getpid()}{extension}")
+
+def duration(seconds):
+    """
+    Format a number of seconds as H:MM:SS.
+    """
+    return str(timedelta(seconds=int(seconds)))
+
+class Progress:
+    """
+    Running counts of an operation over many documents, shown every progress_interval seconds as a progress line
+    with the documents processed, their rate and, if the total is known, the estimated time left.
+    """
+
+    def __init__(self, label, total=None):
+        self.label = label
+        self.total = total
+        self.documents = 0
+        self.counts = {}
+        self.start = time.monotonic()
+        self.next_report = self.start + progress_interval
+
+    def add(self, counter=None, documents=1):
+        """
+        Count processed documents, and their outcome in a counter (e.g. 'updated').
+        """
+        self.documents += documents
+        if counter:
+            self.counts[counter] = self.counts.get(counter, 0) + documents
+        if self.next_report <= time.monotonic():
+            self.report()
+
+    def line(self):
+        """
+        Format the progress line.
+        """
+        elapsed = time.monotonic() - self.start
+        rate = self.documents / elapsed if elapsed else 0
+        if self.total:
+            text = f"{self.label}: {self.documents:,}/{self.total:,} documents ({min(self.documents / self.total, 1):.0%})"
+        else:
+            text = f"{self.label}: {self.documents:,} documents"
+        text += f", {rate:,.0f} documents/s"
+        if self.total and rate:
+            text += f", ETA {duration(max(self.total - self.documents, 0) / rate)}"
+        return text + "".join(f", {counter} {count:,}" for counter, count in self.counts.items())
+
+    def report(self):
+        """
+        Show the progress line and schedule the next one.
+        """
+        message(self.line())
+        self.next_report = time.monotonic() + progress_interval
+
+    def finish(self):
+        """
+        Show the final counts and the time the operation took.
+        """
+        message(f"{self.line()}, done in {duration(time.monotonic() - self.start)}")
@@ -8,183 +8,214 @@ __maintainer__ = "Aldar Cabrelles"
 __email__ = "aldar.cabrelles@crg.eu"
 __status__ = "development"
 
-from . import log_functions
+from . import log_functions, log_storage, scan_functions, bulk_functions, metrics, report
 
-def restoreOne(operation, db, collection_name, reset_criteria, log_id, name, method):
+def valueList(value):
+    """
+    Normalize a field value to a list of values, as the changed_values of the log entries are.
+    """
+    return value if isinstance(value, list) else [value] if value is not None else []
+
+def applyChange(value_list, dropped_values, appended_values):
+    """
+    Drop the dropped values from a value and append the appended values, comparing them by their canonical keys.
+    """
+    dropped_keys = {log_functions.canonicalKey(value) for value in dropped_values}
+    return [value for value in value_list if log_functions.canonicalKey(value) not in dropped_keys] + appended_values
+
+def restoredValue(log_entries, log_id, modified_field, current_value):
+    """
+    Compute the value of modified_field right after the log entry of log_id, from the log entries of the document (newest first).
+    If an entry of the field at or before log_id has a snapshot, the value starts from the nearest one and the entries up to log_id are replayed forward.
+    Otherwise, or if it's shorter, the entries after log_id are undone from the current value.
+    Returns the restored value as a list and the number of log entries replayed.
+    """
+    target = next(index for index, entry in enumerate(log_entries) if entry.get('log_id') == log_id)
+    field_entries = [index for index, entry in enumerate(log_entries) if entry.get('modified_field') == modified_field]
+    newer_entries = [index for index in field_entries if index < target]
+    snapshot = next((index for index in field_entries if index >= target and 'snapshot' in log_entries[index]), None)
+
+    if snapshot is not None:
+        replayed_entries = [index for index in field_entries if target <= index < snapshot]
+        if len(replayed_entries) <= len(newer_entries):
+            # Start from the snapshot and replay the entries after it, oldest first
+            restored_value_list = valueList(scan_functions.decodeValue(log_entries[snapshot]['snapshot']))
+            for index in reversed(replayed_entries):
+                changed_values = log_entries[index].get('changed_values', {})
+                restored_value_list = applyChange(restored_value_list, scan_functions.decodeValue(changed_values.get('removed', [])), scan_functions.decodeValue(changed_values.get('added', [])))
+            return restored_value_list, len(replayed_entries)
+
+    # Undo the entries after log_id from the current value, newest first
+    restored_value_list = valueList(current_value)
+    for index in newer_entries:
+        changed_values = log_entries[index].get('changed_values', {})
+        restored_value_list = applyChange(restored_value_list, scan_functions.decodeValue(changed_values.get('added', [])), scan_functions.decodeValue(changed_values.get('removed', [])))
+    return restored_value_list, len(newer_entries)
+
+def restoredFields(document, log_entries, log_id, process_id, operation):
+    """
+    Compute the restore of every field changed by log_id in a document (an update can change several fields of a document).
+    Returns the restored values of the fields whose current value is different, their log entries, and the number of log entries replayed for every field.
+    """
+    restored_fields = {}
+    new_log_entries = []
+    replayed_entries = {}
+    for modified_field in dict.fromkeys(entry.get('modified_field') for entry in log_entries if entry.get('log_id') == log_id):
+        # Retrieve current value (handle embedded fields)
+        current_value = scan_functions.getFieldValue(document, modified_field)
+
+        # Compute the restored value from the log entries
+        restored_value_list, replayed_entries[modified_field] = restoredValue(log_entries, log_id, modified_field, current_value)
+
+        # Convert single-element lists to a normal string
+        restored_value_list = restored_value_list[0] if len(restored_value_list) == 1 else restored_value_list
+
+        # Check if the restored value is equal to the current value
+        if restored_value_list == current_value or restored_value_list == valueList(current_value):
+            continue
+
+        restored_fields[modified_field] = restored_value_list
+        new_log_entries.append(log_functions.logEntry(process_id, operation, modified_field, current_value, restored_value_list))
+    return restored_fields, new_log_entries, replayed_entries
+
+def restoreOne(operation, db, collection_name, reset_criteria, log_id, name, method, log_backend='embedded', snapshot_interval=0):
     """
     Reset the value of a field (embedded or non-embedded) in a document to a previous version using the log_id.
     """
-    # Access the collection:
+    # Access the collection and its log storage:
     collection = db[collection_name]
+    storage = log_storage.getLogStorage(db, collection_name, log_backend, snapshot_interval)
+    metrics.startRecording()
 
     # Find the document
-    previous_document = collection.find_one(reset_criteria)
+    with metrics.phase("scan"):
+        previous_document = collection.find_one(reset_criteria)
     
     # Check if the document exists
     if not previous_document:
-        print(f"The document you are searching for is not in the collection.")
+        report.warning(f"The document you are searching for is not in the collection.")
         return
 
     # Insert metadata about the restore process in the meta collection
     process_id = log_functions.insertLog(db, name, method, operation, collection_name)
+    metrics.count("documents_scanned", 1)
 
     # Retrieve the logs
-    log_entries = previous_document.get('log', [])
+    with metrics.phase("scan"):
+        log_entries = storage.documentLog(previous_document)
 
     # Find the log entry to restore
     log_entry = next((entry for entry in log_entries if entry.get('log_id') == log_id), None)
     
     if not log_entry:
         log_functions.deleteLog(db, str(process_id))
-        print(f'The log_id: {log_id} does not exist in the document.')
+        report.warning(f'The log_id: {log_id} does not exist in the document.')
         return
 
     if 'update' not in log_entry.get('operation') and 'restore' not in log_entry.get('operation'): 
         log_functions.deleteLog(db, str(process_id))
-        print('Only update|restore operations can be restored.')
+        report.warning('Only update|restore operations can be restored.')
         return
 
-    # Get the field and value to restore
-    modified_field = log_entry.get('modified_field')
-    
-    # Retrieve current value (handle embedded fields)
-    current_value = previous_document
-    for key in modified_field.split("."):
-        current_value = current_value.get(key, None)
-        if current_value is None:
-            break
-    
-    current_value_list = current_value if isinstance(current_value, list) else [current_value] if current_value is not None else []
-
-    print(f"The modified field: {modified_field}")
-
-    looped_logs = 0
-    restored_value_list = current_value_list
-
-    # Loop through the log entries to compute the restored value
-    for entry in log_entries:
-        if entry.get('log_id') == log_id:
-            break
-
-        modified_field_entry = entry.get('modified_field')
-        
-        if modified_field == modified_field_entry:
-            looped_logs += 1
-            print(f"Processing log entry {looped_logs}")
-
-            added_value_list = entry.get('changed_values', {}).get('added', [])
-            removed_value_list = entry.get('changed_values', {}).get('removed', [])
-
-            print(f"Current value from this log entry: {restored_value_list}")
-            print(f"Added values: {added_value_list}")
-            print(f"Removed values: {removed_value_list}")
-
-            # Compute the previous value (restored_value)
-            restored_value_list = [x for x in restored_value_list if x not in added_value_list] + removed_value_list
-            print(f"Restored value after this log entry: {restored_value_list}")
+    # Compute the values of the fields modified by log_id to restore
+    restored_fields, new_log_entries, replayed_entries = restoredFields(previous_document, log_entries, log_id, process_id, operation)
+    for modified_field, looped_logs in replayed_entries.items():
+        report.message(f"The modified field: {modified_field}")
+        report.message(f"Restored value after replaying {looped_logs} log entries: {restored_fields.get(modified_field, 'equal to the current value')}")
 
-    # Convert single-element lists to a normal string
-    restored_value_list = restored_value_list[0] if len(restored_value_list) == 1 else restored_value_list
-
-    # Check if the restored value is equal to the current value
-    if restored_value_list == current_value or restored_value_list == current_value_list:
+    # Check if the restored values are equal to the current values
+    if not restored_fields:
         log_functions.deleteLog(db, str(process_id))
-        print("The current value is already equal to the restored value. No changes were made.")
+        report.message("The current value is already equal to the restored value. No changes were made.")
         return
-    
-    # Create the log object for this operation
-    updated_log = log_functions.updateLog(previous_document, process_id, operation, modified_field, current_value, restored_value_list)
 
     # Perform update
-    result = collection.update_one(reset_criteria, {"$set": {modified_field: restored_value_list, "log": updated_log}})
+    with metrics.phase("write"):
+        result = collection.update_one(reset_criteria, storage.logUpdates(previous_document, new_log_entries, {"$set": restored_fields}))
+        storage.flush()
+    metrics.count("documents_modified", result.modified_count)
 
     if result.modified_count > 0:
-        print(f'Document with stable_id {reset_criteria.get("stable_id")} successfully restored to the value at log {log_id}')
+        metrics.saveMetrics(db, process_id)
+        report.message(f'Document with stable_id {reset_criteria.get("stable_id")} successfully restored to the value at log {log_id}')
     else:
-        print('No changes were made.')
+        report.message('No changes were made.')
 
-def restoreAll(operation, db, collection_name, log_id, name, method):
+def restoreAll(operation, db, collection_name, log_id, name, method, batch_size=1000, log_backend='embedded', snapshot_interval=0, in_flight=0, resume=None):
     """
     Reset a field (embedded or non-embedded) in all documents in the collection to a previous version using log_id.
+    Only the documents whose log contains log_id are read, through an index, and they are restored with adaptive bulk writes starting at batch_size documents.
+    The documents are read in _id order and the last _id written is recorded in the process, resume (the process document) continues after it.
+    With in_flight > 0 the next documents are read and the previous changes written in background threads while a batch is restored.
     """
-    # Access the collection:
+    # Access the collection and its log storage:
     collection = db[collection_name]
+    storage = log_storage.getLogStorage(db, collection_name, log_backend, snapshot_interval)
 
-    # Retrieve all documents in the collection
-    documents = collection.find()
+    metrics.startRecording()
 
-    # Insert metadata about the restore process in the meta collection
-    process_id = log_functions.insertLog(db, name, method, operation, collection_name)
+    # Make sure the documents to restore can be found through an index
+    storage.ensureIndexes()
+
+    # Insert metadata about the restore process in the meta collection, or continue the resumed process after its last _id
+    if resume:
+        process_id = resume["_id"]
+        progress = resume.get("progress", {})
+    else:
+        parameters = {"log_id": log_id, "batch_size": batch_size, "log_backend": log_backend, "snapshot_interval": snapshot_interval}
+        process_id = log_functions.insertLog(db, name, method, operation, collection_name, parameters)
+        progress = {}
     if not process_id:
-        print('Failed to create log for the restore process.')
+        report.warning('Failed to create log for the restore process.')
         return
 
-    restored_documents = 0
-    
-    for document in documents:
-        log_entries = document.get('log', [])
-        
+    # Retrieve only the documents modified in the process, with the fields needed to restore them
+    modified_fields = storage.modifiedFields(log_id)
+    documents = storage.findLogged(log_id, ["stable_id"] + modified_fields, progress.get("last_id"))
+    documents = metrics.scanned(scan_functions.prefetchDocuments(documents, batch_size, in_flight))
+    progress_report = report.Progress(operation, storage.countLogged(log_id, progress.get("last_id")))
+
+    # Prepare the bulk writes of the restored values, recording the last _id written after every batch
+    writer = bulk_functions.BulkWriter(collection, storage, batch_size, checkpoint=lambda last_id: log_functions.saveProgress(db, process_id, {"last_id": last_id, "modified": writer.modified_count}), in_flight=in_flight)
+    writer.modified_count = progress.get("modified", 0)
+
+    for document, log_entries in documents:
         # Find the log entry to restore
         log_entry = next((entry for entry in log_entries if entry.get('log_id') == log_id), None)
         
         if not log_entry:
-            print(f"The log_id {log_id} does not exist in the document with _id {document['_id']}")
+            report.detail("The log_id {} does not exist in the document with _id {}", log_id, document['_id'])
+            progress_report.add("skipped")
             continue
 
         if 'update' not in log_entry.get('operation') and 'restore' not in log_entry.get('operation'):
-            print(f"Only update|restore operations can be restored in document with _id {document['_id']}")
+            report.detail("Only update|restore operations can be restored in document with _id {}", document['_id'])
+            progress_report.add("skipped")
             continue
 
-        # Get the field and value to restore
-        modified_field = log_entry.get('modified_field')
-
-        # Retrieve current value (handle embedded fields)
-        current_value = document
-        for key in modified_field.split("."):
-            current_value = current_value.get(key, None)
-            if current_value is None:
-                break
-        
-        current_value_list = current_value if isinstance(current_value, list) else [current_value] if current_value is not None else []
-        
-        looped_logs = 0
-        restored_value_list = current_value_list
-
-        # Loop through log entries to compute the restored value
-        for entry in log_entries:
-            if entry.get('log_id') == log_id:
-                break
-
-            if entry.get('modified_field') == modified_field:
-                looped_logs += 1
-                added_value_list = entry.get('changed_values', {}).get('added', [])
-                removed_value_list = entry.get('changed_values', {}).get('removed', [])
+        # Compute the values of the fields modified by log_id to restore
+        restored_fields, new_log_entries, _ = restoredFields(document, log_entries, log_id, process_id, operation)
 
-                # Compute the restored value
-                restored_value_list = [x for x in restored_value_list if x not in added_value_list] + removed_value_list
-        
-        # Convert single-element lists to a normal string
-        restored_value_list = restored_value_list[0] if len(restored_value_list) == 1 else restored_value_list
-
-        # Check if the restored value is equal to the current value
-        if restored_value_list == current_value or restored_value_list == current_value_list:
-            print(f"No changes needed for document stable_id {document['stable_id']}, the current value is already equal to the restored value.")
+        # Check if the restored values are equal to the current values
+        if not restored_fields:
+            report.detail("No changes needed for document stable_id {}, the current value is already equal to the restored value.", document.get('stable_id'))
+            progress_report.add("unchanged")
             continue
 
-        # Create the log object for this operation
-        updated_log = log_functions.updateLog(document, process_id, operation, modified_field, current_value, restored_value_list)
+        # Queue the update of the document, with all its restored fields
+        writer.update({"_id": document["_id"]}, storage.logUpdates(document, new_log_entries, {"$set": restored_fields}), document["_id"], document["_id"])
+        report.detail("Document stable_id {} restored to the value at log {}.", document.get('stable_id'), log_id)
+        progress_report.add("restored")
 
-        # Update the document
-        result = collection.update_one(
-            {"_id": document["_id"]},
-            {"$set": {modified_field: restored_value_list, "log": updated_log}}
-        )
+    # Execute the remaining bulk update operations
+    writer.flush()
+    progress_report.finish()
+    restored_documents = writer.modified_count
 
-        if result.modified_count > 0:
-            restored_documents += 1
-    
     if restored_documents == 0:
         log_functions.deleteLog(db, str(process_id))
-        print("No changes were made.")
+        report.message("No changes were made.")
     else:
-        print(f'Field {modified_field} restored successfully to the values at log {log_id} in {restored_documents} documents.')
\ No newline at end of file
+        log_functions.finishProcess(db, process_id)
+        metrics.saveMetrics(db, process_id)
+        report.message(f'Field {", ".join(modified_fields)} restored successfully to the values at log {log_id} in {restored_documents} documents.')
\ No newline at end of file
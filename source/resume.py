@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+"""resume.py  :  Continue an interrupted process from its last recorded progress """
+
+__author__ = "Marta Huertas"
+__version__ = "0.1"
+__maintainer__ = "Aldar Cabrelles"
+__email__ = "aldar.cabrelles@crg.eu"
+__status__ = "development"
+
+# Import Packages
+from bson.objectid import ObjectId
+from . import insert, update_value, restore_value, report
+
+# Operations that record their parameters and progress in log_details and can be resumed
+resumable_operations = ['insert', 'update_all', 'update_with_file', 'restore_all']
+
+def findProcess(db, collection_name, log_id, name):
+    """
+    Find the process to resume: the one with log_id, or the last unfinished process of the person in the collection.
+    """
+    log_collection = db['log_details']
+    if log_id:
+        return log_collection.find_one({"_id": ObjectId(log_id), "collection": collection_name})
+    return log_collection.find_one({"collection": collection_name, "name": name, "status": "running"}, sort=[("date", -1), ("_id", -1)])
+
+def resumeProcess(db, collection_name, log_id, name, in_flight=0):
+    """
+    Continue an interrupted process under the same log_id, with the parameters it was started with, from its last recorded progress.
+    in_flight sets the batches read and written in the background (see bulk_functions.BulkWriter), it doesn't change the result.
+    """
+    process = findProcess(db, collection_name, log_id, name)
+    if not process:
+        report.warning(f"There is no process to resume in the {collection_name} collection.")
+        return
+
+    operation = process["operation"]
+    parameters = process.get("parameters")
+    if operation not in resumable_operations or parameters is None:
+        report.warning(f"The {operation} process {process['_id']} can't be resumed, only {', '.join(resumable_operations)} processes record their progress.")
+        return
+    if process.get("status") == "finished" and operation != 'insert':
+        report.warning(f"The {operation} process {process['_id']} is already finished.")
+        return
+
+    report.message(f"Resuming the {operation} process {process['_id']} started on {process['date']}.")
+
+    if operation == 'insert':
+        # The files of an insert are resumed together, from the progress of all the processes of the run
+        insert.insertDocuments(operation, db, collection_name, parameters["json_documents"], process["name"], process["method"], parameters["workers"], parameters["log_backend"], parameters["insert_mode"], process)
+
+    elif operation == 'update_all':
+        update_value.updateAll(operation, db, collection_name, parameters["update_field"], parameters["new_value"], process["name"], process["method"], parameters["engine"], parameters["log_backend"], parameters.get("batch_size", 1000), parameters.get("snapshot_interval", 0), in_flight, process)
+
+    elif operation == 'update_with_file':
+        update_value.updateFile(operation, db, collection_name, parameters["update_file"], process["name"], process["method"], parameters["batch_size"], parameters["log_backend"], parameters.get("snapshot_interval", 0), in_flight, parameters.get("workers", 1), parameters.get("validation", 'report'), process)
+
+    elif operation == 'restore_all':
+        restore_value.restoreAll(operation, db, collection_name, parameters["log_id"], process["name"], process["method"], parameters["batch_size"], parameters["log_backend"], parameters.get("snapshot_interval", 0), in_flight, process)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+"""scan_functions.py  :  Read only the fields an operation needs from a collection """
+
+__author__ = "Marta Huertas"
+__version__ = "0.1"
+__maintainer__ = "Aldar Cabrelles"
+__email__ = "aldar.cabrelles@crg.eu"
+__status__ = "development"
+
+# Import Packages
+import queue
+import threading
+from collections.abc import Mapping
+from itertools import islice
+import bson
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+# Read and write documents as RawBSONDocuments. In-process stand-ins of MongoDB (e.g. mongomock) don't support them and need it off
+raw_bson = True
+
+def fieldProjection(fields):
+    """
+    Build the projection that returns only the given fields (embedded fields in dot notation) and the _id.
+    Embedded fields whose parent is also requested are dropped, MongoDB doesn't accept both in a projection.
+    """
+    projection = {}
+    for field in sorted(set(fields), key=lambda field: field.count(".")):
+        if not any(field == kept or field.startswith(f"{kept}.") for kept in projection):
+            projection[field] = 1
+    return projection
+
+def scanDocuments(collection, query, fields, raw=True):
+    """
+    Return a cursor over the documents matching the query with only the given fields.
+    With raw=True the documents are RawBSONDocuments, decoded lazily when a key is accessed: fields that are only passed through (e.g. the log) are never decoded.
+    """
+    if raw and raw_bson:
+        collection = collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+    return collection.find(query, fieldProjection(fields))
+
+def prefetchDocuments(documents, batch_size=1000, in_flight=0):
+    """
+    Iterate over the documents while a background thread reads the next ones, up to in_flight batches of batch_size documents ahead.
+    With in_flight=0 the documents are read as they are iterated.
+    """
+    if not in_flight:
+        yield from documents
+        return
+
+    batches = queue.Queue(in_flight)
+
+    def readBatches():
+        try:
+            while True:
+                batch = list(islice(documents, batch_size))
+                batches.put(batch)
+                if not batch:
+                    break
+        except Exception as e:
+            batches.put(e)
+
+    threading.Thread(target=readBatches, daemon=True).start()
+    while True:
+        batch = batches.get()
+        if isinstance(batch, Exception):
+            raise batch
+        if not batch:
+            break
+        yield from batch
+
+def fieldExists(collection, field):
+    """
+    Check if the field exists in at least one document of the collection, reading only the _id of that document.
+    """
+    return collection.find_one({field: {"$exists": True}}, {"_id": 1}) is not None
+
+def decodeValue(value):
+    """
+    Convert a value read from a RawBSONDocument into plain Python objects, so it can be compared with other values.
+    """
+    if isinstance(value, RawBSONDocument):
+        return bson.decode(value.raw)
+    if isinstance(value, list):
+        return [decodeValue(element) for element in value]
+    return value
+
+def getFieldValue(document, field):
+    """
+    Retrieve the value of an embedded or non-embedded field using dot notation. Returns None if the field doesn't exist.
+    """
+    value = document
+    for key in field.split("."):
+        value = value.get(key) if isinstance(value, Mapping) else None
+        if value is None:
+            break
+    return decodeValue(value)
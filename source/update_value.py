@@ -8,162 +8,618 @@ __maintainer__ = "Aldar Cabrelles"
 __email__ = "aldar.cabrelles@crg.eu"
 __status__ = "development"
 
-from . import log_functions
+from . import log_functions, log_storage, index_functions, scan_functions, bulk_functions, arrow_functions, connection, metrics, report
+from bson.objectid import ObjectId
+from multiprocessing import Pool
 import pandas as pd
 import numpy as np
 import os
-from pymongo import UpdateOne
+import time
 from os import listdir
 from os.path import isfile, join, isdir
 import pandas as pd
 import re
 
-def updateOne(operation, db, collection_name, update_criteria, update_field, new_value, name, method):
+def normalizeValue(new_value):
+    """
+    Convert a new value given as a string into the value to be stored: booleans, None or a list for semicolon-separated values.
+    """
+    if isinstance(new_value, str):
+        lowered_value = new_value.lower().strip()  # Normalize case and remove spaces
+
+        if lowered_value in ["true", "false"]:  # Convert boolean-like strings
+            return lowered_value == "true"
+        elif lowered_value == "none":  # Convert "None" string to Python None
+            return None
+        elif ";" in new_value:  # Convert semicolon-separated strings into lists
+            return new_value.split(";")
+    return new_value  # Keep as-is for other values
+
+def updateOne(operation, db, collection_name, update_criteria, update_field, new_value, name, method, log_backend='embedded', snapshot_interval=0):
     """
     Update the value of an embedded or non-embedded field in one document present in a specific collection from the database.
     If the field doesn't exist, the program forcefully creates it at the specified location and adds the given value.
     """
-    # Access the collection:
+    # Access the collection and its log storage:
     collection = db[collection_name]
+    storage = log_storage.getLogStorage(db, collection_name, log_backend, snapshot_interval)
+    metrics.startRecording()
     
     # Find the document before the update to retrieve the previous value
-    previous_document = collection.find_one(update_criteria)
+    with metrics.phase("scan"):
+        previous_document = collection.find_one(update_criteria, scan_functions.fieldProjection([update_field]))
     
     if previous_document:
         updates_made = 0
+        metrics.count("documents_scanned", 1)
 
         # Ensure new_value is processed correctly
-        if isinstance(new_value, str):  
-            lowered_value = new_value.lower().strip()  # Normalize case and remove spaces
-
-            if lowered_value in ["true", "false"]:  # Convert boolean-like strings
-                new_value_list = lowered_value == "true"  
-            elif lowered_value == "none":  # Convert "None" string to Python None
-                new_value_list = None
-            elif ";" in new_value:  # Convert semicolon-separated strings into lists
-                new_value_list = new_value.split(";")
-            else:
-                new_value_list = new_value  # Keep as-is for other strings
-        else:
-            new_value_list = new_value  
+        new_value_list = normalizeValue(new_value)
 
         # Insert metadata about the update process in the log_details collection
         process_id = log_functions.insertLog(db, name, method, operation, collection_name)
 
         # Retrieve the current value using dot notation (for embedded fields)
-        current_value = previous_document
-        for key in update_field.split("."):
-            current_value = current_value.get(key)
-            if current_value is None:
-                break
+        current_value = scan_functions.getFieldValue(previous_document, update_field)
                
         # If the field doesn't exist in the document, explicitly set `None` as the current value
         if current_value is None:
-            print(f"Field {update_field} doesn't exist or has no value in the document. Creating field and setting new value.")
-            updated_log = log_functions.updateLog(previous_document, process_id, operation, update_field, None, new_value_list)
-        elif current_value != new_value_list:
-            print(f"Field {update_field} exists and has a different value in document with stable_id: {list(update_criteria.values())[0]}. Updating the field.")
-            updated_log = log_functions.updateLog(previous_document, process_id, operation, update_field, current_value, new_value_list)
+            report.message(f"Field {update_field} doesn't exist or has no value in the document. Creating field and setting new value.")
+            log_entry = log_functions.logEntry(process_id, operation, update_field, None, new_value_list)
+        elif not log_functions.sameValue(current_value, new_value_list):
+            report.message(f"Field {update_field} exists and has a different value in document with stable_id: {list(update_criteria.values())[0]}. Updating the field.")
+            log_entry = log_functions.logEntry(process_id, operation, update_field, current_value, new_value_list)
         else:
-            print(f"Field {update_field} exists but has the same value in document with stable_id: {list(update_criteria.values())[0]}. No update required.")
+            report.message(f"Field {update_field} exists but has the same value in document with stable_id: {list(update_criteria.values())[0]}. No update required.")
             return  # Exit the function without performing the update if values are the same
 
         # Update the document with the new data
-        result = collection.update_one(update_criteria, {"$set": {update_field: new_value_list, "log": updated_log}})
+        with metrics.phase("write"):
+            result = collection.update_one(update_criteria, storage.logUpdate(previous_document, log_entry, {"$set": {update_field: new_value_list}}))
+            storage.flush()
+        metrics.count("documents_modified", result.modified_count)
             
         # Print whether the document was updated or not
         if result.modified_count > 0:
             updates_made += 1
-            print(f'Field {update_field} updated successfully in the document with stable_id: {list(update_criteria.values())[0]}')
-            print(f'Previous value: {current_value}, New value: {new_value_list}')
-            print('')
+            metrics.saveMetrics(db, process_id)
+            report.message(f'Field {update_field} updated successfully in the document with stable_id: {list(update_criteria.values())[0]}')
+            report.message(f'Previous value: {current_value}, New value: {new_value_list}')
+            report.message('')
         elif updates_made == 0:
             log_functions.deleteLog(db, str(process_id))
-            print("No changes were made.")
+            report.message("No changes were made.")
     else:
-        print(f"The document you are searching for is not in the collection.")
+        report.warning(f"The document you are searching for is not in the collection.")
 
-def updateAll(operation, db, collection_name, update_field, new_value, name, method):
+def updateAllServer(operation, db, collection_name, update_field, new_value, name, method, log_backend='embedded', resume=None):
     """
-    Update the value of an embedded or non-embedded field in all the documents present in a specific collection from the database.
-    If the field doesn't exist, the program forcefully creates it at the specified location and adds the given value.
+    Update the value of an embedded or non-embedded field in all the documents of a collection with a single pipeline update.
+    The current values are compared and the log entries are generated on the server, so no document is transferred.
+    The update only matches the documents that still have to change, so resuming it runs it again under the same process.
     """
-    # Access the collection
+    # Access the collection and its log storage
     collection = db[collection_name]
+    storage = log_storage.getLogStorage(db, collection_name, log_backend)
+    metrics.startRecording()
 
-    # Prepare a list of bulk update operations
-    bulk_updates = []
-
-    # Fetch all documents in the collection
-    previous_documents = collection.find()
-
-    # Insert metadata about the update process in the log_details collection
-    process_id = log_functions.insertLog(db, name, method, operation, collection_name)
+    # Insert metadata about the update process in the log_details collection, or continue the resumed process
+    if resume:
+        process_id = resume["_id"]
+    else:
+        parameters = {"update_field": update_field, "new_value": new_value, "engine": "server", "log_backend": log_backend}
+        process_id = log_functions.insertLog(db, name, method, operation, collection_name, parameters)
 
     # Ensure new_value is processed correctly
-    if isinstance(new_value, str):
-        lowered_value = new_value.lower().strip()  # Normalize case and remove spaces
+    new_value_list = normalizeValue(new_value)
+
+    # Update the documents where the field doesn't exist, has no value or has a different value
+    current_value = {"$ifNull": [f"${update_field}", None]}
+    query = {"$expr": {"$or": [{"$eq": [current_value, None]}, {"$ne": [current_value, {"$literal": new_value_list}]}]}}
+    with metrics.phase("write"):
+        result = collection.update_many(query, storage.logPipeline(query, process_id, operation, update_field, f"${update_field}", new_value_list) + [
+            {"$set": {update_field: {"$literal": new_value_list}}}
+        ])
+    metrics.count("documents_scanned", result.matched_count)
+    metrics.count("documents_modified", result.modified_count)
+
+    updates_made = result.modified_count
+    if resume:
+        # The documents updated before the interruption are logged under the process, it's kept even if nothing was left to update
+        log_functions.finishProcess(db, process_id)
+        metrics.saveMetrics(db, process_id)
+        report.message(f'{updates_made} more document(s) updated successfully. New value for {update_field}: {new_value_list}')
+    elif result.matched_count == 0:
+        log_functions.deleteLog(db, str(process_id))
+        report.message("No changes were necessary. All values were already up to date.")
+    elif updates_made == 0:
+        log_functions.deleteLog(db, str(process_id))
+        report.message("No changes were made.")
+    else:
+        log_functions.finishProcess(db, process_id)
+        metrics.saveMetrics(db, process_id)
+        report.message(f'{updates_made} document(s) updated successfully. New value for {update_field}: {new_value_list}')
 
-        if lowered_value in ["true", "false"]: # Convert boolean-like strings  
-            new_value_list = lowered_value == "true"  
-        elif lowered_value == "none": # Convert "None" string to Python None  
-            new_value_list = None   
-        elif ";" in new_value:  # Convert semicolon-separated strings into lists
-            new_value_list = new_value.split(";")
-        else:
-            new_value_list = new_value  # Keep as-is for other strings
+def updateAll(operation, db, collection_name, update_field, new_value, name, method, engine='client', log_backend='embedded', batch_size=1000, snapshot_interval=0, in_flight=0, resume=None):
+    """
+    Update the value of an embedded or non-embedded field in all the documents present in a specific collection from the database.
+    If the field doesn't exist, the program forcefully creates it at the specified location and adds the given value.
+    With the 'server' engine the whole update runs in MongoDB as one pipeline update (see updateAllServer).
+    With the 'client' engine the changes are written in adaptive bulk writes starting at batch_size documents (see bulk_functions.BulkWriter).
+    The documents are scanned in _id order and the last _id written is recorded in the process, resume (the process document) continues after it.
+    With in_flight > 0 the next documents are read and the previous changes written in background threads while a batch is compared.
+    """
+    if engine == 'server':
+        updateAllServer(operation, db, collection_name, update_field, new_value, name, method, log_backend, resume)
+        return
+
+    # Access the collection and its log storage
+    collection = db[collection_name]
+    storage = log_storage.getLogStorage(db, collection_name, log_backend, snapshot_interval)
+    metrics.startRecording()
+
+    # Insert metadata about the update process in the log_details collection, or continue the resumed process after its last _id
+    query = {}
+    if resume:
+        process_id = resume["_id"]
+        progress = resume.get("progress", {})
+        if "last_id" in progress:
+            query = {"_id": {"$gt": progress["last_id"]}}
     else:
-        new_value_list = new_value    
+        parameters = {"update_field": update_field, "new_value": new_value, "engine": engine, "log_backend": log_backend, "batch_size": batch_size, "snapshot_interval": snapshot_interval}
+        process_id = log_functions.insertLog(db, name, method, operation, collection_name, parameters)
+        progress = {}
+
+    # Prepare the bulk writes of the updates, recording the last _id written after every batch
+    writer = bulk_functions.BulkWriter(collection, storage, batch_size, checkpoint=lambda last_id: log_functions.saveProgress(db, process_id, {"last_id": last_id, "modified": writer.modified_count}), in_flight=in_flight)
+    writer.modified_count = progress.get("modified", 0)
+    updates_queued = 0
+
+    # Fetch all documents in the collection, only with the fields needed for the update
+    previous_documents = scan_functions.scanDocuments(collection, query, ["stable_id", update_field]).sort("_id", 1)
+    progress_report = report.Progress(operation, collection.count_documents(query) if query else collection.estimated_document_count())
+    previous_documents = metrics.scanned(scan_functions.prefetchDocuments(previous_documents, batch_size, in_flight))
+
+    # Ensure new_value is processed correctly, and prepare its side of the log entries once for all the documents
+    new_value_list = normalizeValue(new_value)
+    new_keys = log_functions.valueKeys(new_value_list)
 
     # Loop through each document
     for document in previous_documents:
         stable_id = document.get('stable_id', 'Unknown stable_id')
 
         # Retrieve the current value using dot notation 
-        current_value = document
-        for key in update_field.split("."):
-            current_value = current_value.get(key)
-            if current_value is None:
-                break
+        current_value = scan_functions.getFieldValue(document, update_field)
 
         if current_value is None:
             # If the field is set as Null or doesn't exist, create it and set the new value
-            print(f"Field {update_field} doesn't exist or has no value in document with stable_id: {stable_id}. Creating field and setting new value.")
-            updated_log = log_functions.updateLog(document, process_id, operation, update_field, None, new_value_list)
-            bulk_updates.append(UpdateOne(
-                {"_id": document["_id"]},
-                {"$set": {update_field: new_value_list, "log": updated_log}}
-            ))
-        elif current_value != new_value_list:
+            report.detail("Field {} doesn't exist or has no value in document with stable_id: {}. Creating field and setting new value.", update_field, stable_id)
+            log_entry = log_functions.logEntry(process_id, operation, update_field, None, new_value_list, new_keys)
+            writer.update({"_id": document["_id"]}, storage.logUpdate(document, log_entry, {"$set": {update_field: new_value_list}}), document["_id"], document["_id"])
+            updates_queued += 1
+            progress_report.add("created")
+        elif not log_functions.sameValue(current_value, new_value_list):
             # If the field exists but the value is different, update it
-            print(f"Field {update_field} exists and has a different value in document with stable_id: {stable_id}. Updating the field.")
-            updated_log = log_functions.updateLog(document, process_id, operation, update_field, current_value, new_value_list)
-            bulk_updates.append(UpdateOne(
-                {"_id": document["_id"]},
-                {"$set": {update_field: new_value_list, "log": updated_log}}
-            ))
+            report.detail("Field {} exists and has a different value in document with stable_id: {}. Updating the field.", update_field, stable_id)
+            log_entry = log_functions.logEntry(process_id, operation, update_field, current_value, new_value_list, new_keys)
+            writer.update({"_id": document["_id"]}, storage.logUpdate(document, log_entry, {"$set": {update_field: new_value_list}}), document["_id"], document["_id"])
+            updates_queued += 1
+            progress_report.add("changed")
         else:
             # If the field exists and the value is the same, no update is needed
-            print(f"Field {update_field} exists but has the same value in document with stable_id: {stable_id}. No update required.")
+            report.detail("Field {} exists but has the same value in document with stable_id: {}. No update required.", update_field, stable_id)
+            progress_report.add("unchanged")
+
+    # Execute the remaining bulk update operations
+    writer.flush()
+    progress_report.finish()
+    updates_made = writer.modified_count
+    if updates_made:
+        log_functions.finishProcess(db, process_id)
+        metrics.saveMetrics(db, process_id)
+        report.message(f'{updates_made} document(s) updated successfully. New value for {update_field}: {new_value_list}')
+    elif updates_queued:
+        log_functions.deleteLog(db, str(process_id))
+        report.message("No changes were made.")
+    else:
+        log_functions.deleteLog(db, str(process_id))
+        report.message("No changes were necessary. All values were already up to date.")
 
-    # Execute the bulk update operations
-    if bulk_updates:
-        result = collection.bulk_write(bulk_updates)
-        updates_made = result.modified_count
-        if updates_made == 0:
-            log_functions.deleteLog(db, str(process_id))
-            print("No changes were made.")
+def setFieldValue(document, field, value):
+    """
+    Set the value of an embedded or non-embedded field in a local copy of a document using dot notation.
+    """
+    keys = field.split(".")
+    for key in keys[:-1]:
+        if not isinstance(document.get(key), dict):
+            document[key] = {}
+        document = document[key]
+    document[keys[-1]] = value
+
+def normalizeColumn(values):
+    """
+    Convert the values of a column read from a CSV file or a Parquet/Arrow file into the values to be stored, the whole column at once:
+    None for empty cells, a list for semicolon-separated strings, and Python booleans and numbers instead of NumPy ones.
+    Lists and embedded documents of Parquet/Arrow columns are stored as they are.
+    """
+    # Python values (Parquet/Arrow columns) are kept as objects, so pandas doesn't turn integer columns with nulls into floats
+    column = values if isinstance(values, pd.Series) else pd.Series(values, dtype=object)
+    missing = column.isna().to_numpy()
+    normalized = column.to_numpy(dtype=object, copy=True)
+    normalized[missing] = None
+
+    # Only the strings with a semicolon are split, the other values of the column are not looked at again
+    if pd.api.types.infer_dtype(column, skipna=True) == "string":
+        separated = column.str.contains(";", regex=False, na=False).to_numpy(dtype=bool)
+        if separated.any():
+            normalized[separated] = column[separated].str.split(";").to_numpy()
+    return normalized.tolist()
+
+def updateBatch(operation, writer, storage, process_id, field_to_match, update_fields, rows, first_row=0, progress_report=None):
+    """
+    Update the documents of a batch of CSV rows (value to match, new values of the update_fields normalized with normalizeColumn), first_row being the number of rows of the file before the batch.
+    The documents are fetched with a single $in query, the new values and logs are computed locally, and the changes are queued in the bulk writer:
+    documents with updates of earlier batches not written yet are fetched again once the writer is flushed, so they are never compared out of date.
+    all the fields changed in a document go in one $set, with one log entry per changed field.
+    The outcome of every row is counted in progress_report (see report.Progress).
+    """
+    progress_report = progress_report or report.Progress(operation, len(rows))
+    collection = writer.collection
+
+    # Fetch all the documents of the batch at once
+    values = list({value_to_match for value_to_match, _ in rows})
+    projection = scan_functions.fieldProjection([field_to_match] + update_fields)
+    documents = list(metrics.scanned(collection.find({field_to_match: {"$in": values}}, projection)))
+    if writer.pending({document["_id"] for document in documents}):
+        # Earlier rows of the file changed some of these documents, read them again once their updates are written
+        writer.flush()
+        documents = list(metrics.scanned(collection.find({field_to_match: {"$in": values}}, projection)))
+
+    # Keep the first match of every value as find_one would
+    previous_documents = {}
+    for document in documents:
+        matched_value = scan_functions.getFieldValue(document, field_to_match)
+        for value in matched_value if isinstance(matched_value, list) else [matched_value]:
+            previous_documents.setdefault(value, document)
+
+    for row_number, (value_to_match, new_values) in enumerate(rows, first_row + 1):
+        # Find the document before the update to retrieve the previous values
+        previous_document = previous_documents.get(value_to_match)
+
+        if previous_document:
+            new_fields = {}
+            log_entries = []
+            for update_field, new_value_list in zip(update_fields, new_values):
+                # Retrieve the current value using dot notation
+                current_value = scan_functions.getFieldValue(previous_document, update_field)
+
+                if current_value is None:
+                    # If the field is set as Null or doesn't exist, create it and set the new value
+                    report.detail("Field '{}' doesn't exist or has no value in document with stable_id: {}. Creating field and setting new value.", update_field, value_to_match)
+                elif not log_functions.sameValue(current_value, new_value_list):
+                    report.detail("Field '{}' already exists and has a different value in document with stable_id: {}. Updating the field.", update_field, value_to_match)
+                else:
+                    report.detail("Field '{}' already exists and has the same value in document with stable_id: {}. No update required.", update_field, value_to_match)
+                    continue
+
+                new_fields[update_field] = new_value_list
+                log_entries.append(log_functions.logEntry(process_id, operation, update_field, current_value, new_value_list))
+
+            if not new_fields:
+                progress_report.add("unchanged")
+                continue
+            progress_report.add("changed")
+
+            # A document is only written once per bulk write, the writer sends the pending updates first for rows repeating a document
+            writer.update({"_id": previous_document["_id"]}, storage.logUpdates(previous_document, log_entries, {"$set": new_fields}), previous_document["_id"], row_number)
+
+            # Keep the local copy up to date for later rows of the same document
+            for update_field, new_value_list in new_fields.items():
+                setFieldValue(previous_document, update_field, new_value_list)
         else:
-            print(f'{updates_made} document(s) updated successfully. New value for {update_field}: {new_value_list}')
+            report.detail("The document with '{}': {} is not in the collection.", field_to_match, value_to_match)
+            progress_report.add("missing")
+
+def countRows(csv_file):
+    """
+    Count the rows of a CSV file below its header from its line breaks, without parsing it.
+    Values with line breaks inside quotes are counted as several rows, so it's an estimate for such files.
+    """
+    with open(csv_file, "rb") as f:
+        line_breaks = 0
+        last_block = b""
+        for block in iter(lambda: f.read(1 << 20), b""):
+            line_breaks += block.count(b"\n")
+            last_block = block
+    # The last row may not end with a line break
+    lines = line_breaks + (1 if last_block and not last_block.endswith(b"\n") else 0)
+    return max(lines - 1, 0)
+
+def csvDtypes(csv_file, columns, chunk_size):
+    """
+    Find the dtypes to read the given columns of a CSV file with, so every chunk gets the types pandas infers when the whole file is read at once:
+    float for numbers with decimals or empty cells, str for columns mixing types, and no dtype for columns that are read the same way in any chunk.
+    The columns are read once in chunks of chunk_size rows to look at their values.
+    """
+    kinds = {column: set() for column in columns}
+    for chunk in pd.read_csv(csv_file, usecols=columns, chunksize=chunk_size):
+        for column in columns:
+            if chunk[column].isna().any():
+                kinds[column].add("empty")
+            if chunk[column].notna().any():
+                kinds[column].add(pd.api.types.infer_dtype(chunk[column], skipna=True))
+
+    dtypes = {}
+    for column, column_kinds in kinds.items():
+        value_kinds = column_kinds - {"empty"}
+        if value_kinds <= {"boolean"} or column_kinds == {"integer"}:
+            continue
+        dtypes[column] = float if value_kinds <= {"integer", "floating"} else str
+    return dtypes
+
+def readCsvChunks(csv_file, field_to_match, columns, chunk_size, skip_rows=0):
+    """
+    Read the given columns of a CSV file in chunks of chunk_size rows (DataFrames), after skipping the first skip_rows rows.
+    The field to match is read as strings, so accessions that look like numbers (e.g. with leading zeros) are kept as they are written.
+    The other columns get the same dtype in every chunk (see csvDtypes), whatever rows a chunk starts at.
+    Only one chunk is in memory at a time, and the first chunk can be processed before the rest of the file is read.
+    """
+    update_columns = [column for column in columns if column != field_to_match]
+    with metrics.phase("read"):
+        dtypes = csvDtypes(csv_file, update_columns, chunk_size) if update_columns else {}
+    chunks = pd.read_csv(csv_file, usecols=columns, dtype={**dtypes, field_to_match: str}, chunksize=chunk_size, skiprows=range(1, skip_rows + 1))
+    while True:
+        with metrics.phase("read"):
+            chunk = next(chunks, None)
+        if chunk is None:
+            break
+        yield chunk
+
+def readFileColumns(update_file, fields, batch_size, skip_rows=0):
+    """
+    Yield the values of the given fields of a CSV, Parquet or Arrow file, one sequence of values per field for every batch of batch_size rows,
+    after skipping the first skip_rows rows. The fields of a Parquet or Arrow file are its columns, with the fields of struct columns in dot notation.
+    """
+    if update_file.endswith(arrow_functions.arrow_extensions):
+        columns = arrow_functions.readColumns(update_file, fields, batch_size, skip_rows)
+        while True:
+            with metrics.phase("read"):
+                batch = next(columns, None)
+            if batch is None:
+                break
+            yield batch
+    else:
+        for chunk in readCsvChunks(update_file, fields[0], fields, batch_size, skip_rows):
+            # The columns are taken one by one, so every one keeps its own dtype
+            yield [chunk[field] for field in fields]
+
+def fileFields(update_file):
+    """
+    Read the header of a CSV file, or the schema of a Parquet or Arrow file: the field to match is the first column and the fields to update are the other columns.
+    Returns None if the file can't be used for an update, after warning about it.
+    """
+    if update_file.endswith(arrow_functions.arrow_extensions):
+        column_names = arrow_functions.fieldNames(update_file)
+    else:
+        column_names = pd.read_csv(update_file, nrows=0).columns.to_list()
+    field_to_match = column_names[0]  # The header from the first column will always be the field to match
+    update_fields = column_names[1:]  # The headers from the other columns are the fields to update
+
+    # A field and a field embedded in it can't be set by the same update
+    overlapping_fields = [field for field in update_fields if any(field.startswith(f"{other_field}.") for other_field in update_fields)]
+    if not update_fields or overlapping_fields:
+        report.warning(f"{update_file} needs the field to match and at least one field to update, and can't update a field together with a field embedded in it ({', '.join(overlapping_fields)}).")
+        return None
+    return field_to_match, update_fields
+
+def updateCsvFile(operation, db, collection_name, csv_file, name, method, batch_size=1000, log_backend='embedded', snapshot_interval=0, in_flight=0, parameters=None, resume=None):
+    """
+    Update the documents matching the rows of one CSV, Parquet or Arrow file, as one process.
+    resume (the process document of the file) continues the file after its last row written.
+    Returns the number of documents updated.
+    """
+    if not csv_file.endswith((".csv",) + arrow_functions.arrow_extensions):
+        report.warning(f"{csv_file} is not a CSV, Parquet or Arrow file.")
+        return 0
+    if csv_file.endswith(arrow_functions.arrow_extensions) and not arrow_functions.checkPyarrow(csv_file):
+        return 0
+
+    report.message(f'Importing {csv_file}')
+    metrics.startRecording()
+
+    # Extract column headers, the file is read later in chunks
+    fields = fileFields(csv_file)
+    if not fields:
+        return 0
+    field_to_match, update_fields = fields
+
+    total_rows = arrow_functions.countRows(csv_file) if csv_file.endswith(arrow_functions.arrow_extensions) else countRows(csv_file)
+    report.message(f'There are {total_rows} objects to update.')
+
+    # Access the collection and its log storage:
+    collection = db[collection_name]
+    storage = log_storage.getLogStorage(db, collection_name, log_backend, snapshot_interval)
+
+    # The documents are looked up by the field to match
+    index_functions.reportMissingIndexes(collection, [field_to_match])
+
+    # Begin processing updates
+    report.message(f"Processing updates...")
+
+    # Insert metadata about the update process, or continue the resumed process after its last row written
+    if resume:
+        process_id = resume["_id"]
+        progress = resume.get("progress", {})
+        report.message(f"Resuming after row {progress.get('rows', 0)}.")
+    else:
+        process_id = log_functions.insertLog(db, name, method, operation, collection_name, {**(parameters or {}), "file": csv_file})
+        progress = {}
+
+    # Process the rows in chunks of batch_size rows as they are read: one lookup per chunk and bulk writes instead of one of each per row, recording the rows written after every write
+    writer = bulk_functions.BulkWriter(collection, storage, batch_size, checkpoint=lambda rows_done: log_functions.saveProgress(db, process_id, {"rows": rows_done, "modified": writer.modified_count}), in_flight=in_flight)
+    writer.modified_count = progress.get("modified", 0)
+    start = progress.get("rows", 0)
+    progress_report = report.Progress(f"{operation} {csv_file}", total_rows - start)
+    for columns in readFileColumns(csv_file, [field_to_match] + update_fields, batch_size, start):
+        # The new values are normalized a column at a time before they are compared
+        with metrics.phase("prepare"):
+            rows = list(zip(columns[0], zip(*(normalizeColumn(column) for column in columns[1:]))))
+        with metrics.phase("diff"):
+            updateBatch(operation, writer, storage, process_id, field_to_match, update_fields, rows, start, progress_report)
+        start += len(rows)
+    writer.flush()
+    progress_report.finish()
+
+    # Track the documents that were actually updated
+    updates_made = writer.modified_count
+
+    # Log the results of updates
+    if updates_made > 0:
+        log_functions.finishProcess(db, process_id)
+        metrics.saveMetrics(db, process_id)
+        report.message(f"Total number of updates made: {updates_made}.")
     else:
         log_functions.deleteLog(db, str(process_id))
-        print("No changes were necessary. All values were already up to date.")
+        report.message(f"No changes were made.")
+    return updates_made
+
+def fieldsOverlap(fields, other_fields):
+    """
+    Check if two lists of fields (dot notation) share a field, or a field and a field embedded in it.
+    """
+    return any(field == other_field or field.startswith(f"{other_field}.") or other_field.startswith(f"{field}.") for field in fields for other_field in other_fields)
 
-def updateFile(operation, db, collection_name, update_file, name, method):
+def scanFiles(csv_files, batch_size=1000):
+    """
+    Read the field to match, the fields to update and the values to match (a Series, one per row) of every file, reading only the column of the field to match.
+    Files that won't be updated are None.
     """
-    Update the value of an embedded or non-embedded field in multiple documents with information from a CSV file.
+    files = []
+    for csv_file in csv_files:
+        readable = csv_file.endswith(".csv") or (csv_file.endswith(arrow_functions.arrow_extensions) and arrow_functions.pa is not None)
+        fields = fileFields(csv_file) if readable else None
+        if fields:
+            field_to_match, update_fields = fields
+            keys = [pd.Series(columns[0], dtype=object) for columns in readFileColumns(csv_file, [field_to_match], batch_size)]
+            fields = (field_to_match, update_fields, pd.concat(keys, ignore_index=True) if keys else pd.Series([], dtype=object))
+        files.append(fields)
+    return files
+
+def existingValues(collection, field_to_match, values, batch_size=1000):
+    """
+    Return the values of field_to_match that are in documents of the collection, looked up with $in queries of batch_size values that only read the field.
+    """
+    existing = set()
+    for start in range(0, len(values), batch_size):
+        for document in scan_functions.scanDocuments(collection, {field_to_match: {"$in": values[start:start + batch_size]}}, [field_to_match]):
+            matched_value = scan_functions.getFieldValue(document, field_to_match)
+            existing.update(matched_value if isinstance(matched_value, list) else [matched_value])
+    return existing
+
+def validateFiles(db, collection_name, csv_files, files, batch_size=1000):
+    """
+    Check the files of an update before anything is written and report, for every file: the values to match repeated in the file
+    (the last row sets the values), the values to match of earlier files (the last file sets the values of the fields both update), the values that match no document and the empty ones.
+    The values are checked a whole column at a time, and looked up in the collection with $in queries (see existingValues).
+    Returns the number of problems found.
+    """
+    start = time.monotonic()
+    report.message("Validating the files before updating...")
+    collection = db[collection_name]
+
+    # Look up the values to match of all the files at once, by field to match
+    existing = {}
+    for field_to_match in dict.fromkeys(fields[0] for fields in files if fields):
+        values = pd.concat([fields[2] for fields in files if fields and fields[0] == field_to_match], ignore_index=True).dropna().unique()
+        existing[field_to_match] = existingValues(collection, field_to_match, [value.item() if isinstance(value, np.generic) else value for value in values], batch_size)
+
+    problems = 0
+    earlier_values = {}
+    for csv_file, fields in zip(csv_files, files):
+        if not fields:
+            continue
+        field_to_match, update_fields, keys = fields
+        present = keys.notna()
+        duplicated_values = keys[present & keys.duplicated(keep=False)].unique()
+        earlier = earlier_values.get(field_to_match, pd.Series([], dtype=object))
+        repeated_values = keys[present & keys.isin(earlier)].unique()
+        missing_values = keys[present & ~keys.isin(existing[field_to_match])].unique()
+        empty_rows = int((~present).sum())
+        earlier_values[field_to_match] = pd.concat([earlier, keys[present]], ignore_index=True).drop_duplicates()
+
+        report.message(f"{csv_file}: {len(keys)} rows, {keys[present].nunique()} values of {field_to_match}, {len(duplicated_values)} repeated in the file, "
+                       f"{len(repeated_values)} in earlier files, {len(missing_values)} not in the collection, {empty_rows} rows without value.")
+        for problem, values in [("repeated in the file", duplicated_values), ("in earlier files", repeated_values), ("not in the collection", missing_values)]:
+            if len(values):
+                report.message(f"  {field_to_match} {problem}: {', '.join(str(value) for value in values[:5])}{', ...' if len(values) > 5 else ''}")
+            for value in values:
+                report.detail("{} {} of {} is {}.", field_to_match, value, csv_file, problem)
+        problems += len(duplicated_values) + len(repeated_values) + len(missing_values) + empty_rows
+
+    report.message(f"Validation finished in {time.monotonic() - start:.1f} seconds, {problems} problem(s) found.")
+    return problems
+
+def fileGroups(csv_files, files):
+    """
+    Split the CSV, Parquet and Arrow files into groups that can be updated in parallel: two files are in the same group if they update the same field
+    (or a field embedded in it) of the same document, directly or through other files of the group. The files of a group keep their order,
+    so the last file still sets the final value of a field updated by several files, as when the files are updated one after another.
+    files are the fields and values to match of every file (see scanFiles), files matching different fields can't be compared and are grouped if they update the same fields.
+    """
+    # Values to match of every file, files that won't be updated are groups on their own
+    files = [(fields[0], fields[1], set(fields[2])) if fields else None for fields in files]
+
+    # Join the groups of the files that update the same fields of the same documents
+    group_of = list(range(len(csv_files)))
+
+    def findGroup(index):
+        while group_of[index] != index:
+            group_of[index] = group_of[group_of[index]]
+            index = group_of[index]
+        return index
+
+    for index, fields in enumerate(files):
+        if not fields:
+            continue
+        for other_index in range(index):
+            other_fields = files[other_index]
+            if not other_fields or findGroup(index) == findGroup(other_index) or not fieldsOverlap(fields[1], other_fields[1]):
+                continue
+            if fields[0] != other_fields[0] or not fields[2].isdisjoint(other_fields[2]):
+                group_of[findGroup(index)] = findGroup(other_index)
+
+    groups = {}
+    for index, csv_file in enumerate(csv_files):
+        groups.setdefault(findGroup(index), []).append(csv_file)
+    return list(groups.values())
+
+def runProcesses(db, collection_name, run_id):
+    """
+    Read the processes of the files of a parallel update run, by file.
+    """
+    return {process["parameters"]["file"]: process for process in db['log_details'].find({"collection": collection_name, "parameters.run_id": run_id})}
+
+def updateFilesWorker(arguments):
+    """
+    Update a group of files in order from a worker process using the connection of the worker.
+    """
+    operation, collection_name, csv_files, name, method, batch_size, log_backend, snapshot_interval, in_flight, parameters, processes = arguments
+    return sum(updateCsvFile(operation, connection.worker_db, collection_name, csv_file, name, method, batch_size, log_backend, snapshot_interval, in_flight, parameters, processes.get(csv_file)) for csv_file in csv_files)
+
+# Validation of the files of update_with_file before any write: '' (none), 'report' (report the problems and update) or 'strict' (report the problems and don't update if there are any)
+validation_modes = ['', 'report', 'strict']
+
+def updateFile(operation, db, collection_name, update_file, name, method, batch_size=1000, log_backend='embedded', snapshot_interval=0, in_flight=0, workers=1, validation='report', resume=None):
+    """
+    Update the value of an embedded or non-embedded field in multiple documents with information from a CSV, Parquet or Arrow file.
     If the field doesn't exist, the program forcefully creates it at the specified location and adds the given value.
-    Supports a single CSV file or multiple files in a directory.
+    Supports a single file or multiple files in a directory. The fields of the struct columns of Parquet and Arrow files are embedded fields (dot notation).
+    The files are read in chunks of batch_size rows (see readCsvChunks), the documents of a chunk are fetched with one query and written in adaptive bulk writes starting at batch_size documents.
+    Every file is a process that records the rows written, resume (the process document of a file) continues that file after its last row written and then the next files.
+    With in_flight > 0 the changes are written in a background thread while the next batches are looked up and compared.
+    With more than one worker, the files of a directory are updated in parallel by a pool of processes, in groups of files that don't update the same fields of the same documents (see fileGroups).
+    The processes of a parallel update share a run_id, resume (any process document of the run) continues the files of every group after the last one started.
+    With validation, the files are checked before any process is created (see validateFiles), and 'strict' stops if there are problems.
     """
 
     # Determine if it's a single file or a directory
@@ -171,91 +627,68 @@ def updateFile(operation, db, collection_name, update_file, name, method):
         # Obtain list of elements found in the directory, turn them into iterable lists
         if isfile(update_file):
             csv_files = [update_file]
-            print("There is 1 file to process.")
+            report.message("There is 1 file to process.")
         elif isdir(update_file):
             csv_files = [update_file + "/" + f for f in listdir(update_file) if isfile(join(update_file, f))]
             csv_files = sorted(csv_files, key=lambda s: [int(text) if text.isdigit() else text.lower() for text in re.split('([0-9]+)', s)])
-            print(f'There are {len(csv_files)} files to process.')
+            report.message(f'There are {len(csv_files)} files to process.')
+
+        parameters = {"update_file": update_file, "batch_size": batch_size, "log_backend": log_backend, "snapshot_interval": snapshot_interval, "validation": validation}
+        parallel = workers > 1 and len(csv_files) > 1
+        total_updates = 0
+
+        # Skip the files processed before the resumed one
+        if resume and not parallel:
+            resume_file = resume["parameters"]["file"]
+            if resume_file not in csv_files:
+                report.warning(f"The file {resume_file} of the resumed process is not in {update_file} anymore.")
+                return
+            csv_files = csv_files[csv_files.index(resume_file):]
+            report.message(f'Resuming from {resume_file}, {len(csv_files)} file(s) left to process.')
+
+        # Read the values to match of the files, to check them and to find the files that can be updated in parallel
+        files = scanFiles(csv_files, batch_size) if validation or parallel else None
+        if validation and validateFiles(db, collection_name, csv_files, files, batch_size) and validation == 'strict':
+            report.warning("The files were not updated, fix the problems found or use the 'report' validation to update them anyway.")
+            return
+
+        if parallel:
+            # Continue the resumed run from the processes of its files
+            run_id = resume["parameters"]["run_id"] if resume else str(ObjectId())
+            processes = runProcesses(db, collection_name, run_id) if resume else {}
+            parameters.update({"workers": workers, "run_id": run_id})
+
+            # Files that update the same fields of the same documents are updated in order by the same worker
+            report.message("Looking for files that update the same fields of the same documents...")
+            groups = fileGroups(csv_files, files)
+
+            # The files of a group are updated one after another, so the files before the last one started were finished
+            if resume:
+                for position, group in enumerate(groups):
+                    started = [index for index, csv_file in enumerate(group) if csv_file in processes]
+                    if started:
+                        last_started = started[-1] + (processes[group[started[-1]]].get("status") == "finished")
+                        groups[position] = group[last_started:]
+                groups = [group for group in groups if group]
+                processes = {csv_file: process for csv_file, process in processes.items() if process.get("status") == "running"}
+                report.message(f"Resuming the update, {sum(len(group) for group in groups)} file(s) left to process.")
+
+            # Spread the groups across a pool of processes, each with its own MongoDB connection
+            report.message(f"Processing {len(groups)} group(s) of files with {min(workers, len(groups))} workers.")
+            with Pool(max(min(workers, len(groups)), 1), initializer=connection.initWorker, initargs=(db.name,)) as pool:
+                arguments = [(operation, collection_name, group, name, method, batch_size, log_backend, snapshot_interval, in_flight, parameters, processes) for group in groups]
+                for updates_made in pool.imap_unordered(updateFilesWorker, arguments):
+                    # Track total updates made across files
+                    total_updates += updates_made
+            report.message(f"Total number of updates made across files: {total_updates}.")
+            report.message("Updates finished!")
+            return
 
         # Begin loop
         for f in csv_files:
-            if f.endswith(".csv"):
-                print(f'Importing {f}')
-                update_data = pd.read_csv(f)
-
-                # Extract column headers
-                column_names = update_data.columns.to_list()
-                field_to_match = column_names[0]  # The header from the first column will always be the field to match
-                update_field = column_names[1]  # The header from the second column will always be the update field
-
-                # Get the values from the columns
-                values_to_match = update_data[field_to_match].values # The stable_id's
-                new_values = update_data[update_field].values # The new values
-
-                print(f'There are {len(values_to_match)} objects to update.')
-
-                # Access the collection:
-                collection = db[collection_name]
-
-                # Begin processing updates
-                print(f"Processing updates...")
-
-                # Insert metadata about the update process
-                process_id = log_functions.insertLog(db, name, method, operation, collection_name)
-
-                # Track the documents that were actually updated
-                updates_made = 0
-
-                for value_to_match, new_value in zip(values_to_match, new_values):
-                    # Ensure new_value is processed correctly
-                    if pd.isna(new_value) or new_value is None:
-                        new_value_list = None # if value is absent or None
-                    elif isinstance(new_value, np.bool_):
-                        new_value_list = bool(new_value) # if a value is a numpy bool (boolean)
-                    else:
-                        new_value_list = new_value.split(";") if isinstance(new_value, str) and ";" in new_value else new_value  # if a value is a single string element or several string elements (list)
-                        
-                    # Stable id of the object to be updated
-                    update_criteria = {field_to_match: value_to_match}
-
-                    # Find the document before the update to retrieve the previous value
-                    previous_document = collection.find_one(update_criteria)
-
-                    if previous_document:
-                        # Retrieve the current value using dot notation 
-                        current_value = previous_document
-                        for key in update_field.split("."):
-                            current_value = current_value.get(key)
-                            if current_value is None:
-                                break
-
-                        if current_value is None:
-                            # If the field is set as Null or doesn't exist, create it and set the new value
-                            print(f"Field '{update_field}' doesn't exist or has no value in document with stable_id: {value_to_match}. Creating field and setting new value.")
-                            updated_log = log_functions.updateLog(previous_document, process_id, operation, update_field, None, new_value_list)
-                            result = collection.update_one(update_criteria, {"$set": {update_field: new_value_list, "log": updated_log}})
-                            if result.modified_count > 0:
-                                updates_made += 1
-                        elif current_value != new_value_list:
-                            print(f"Field '{update_field}' already exists and has a different value in document with stable_id: {value_to_match}. Updating the field.")
-                            updated_log = log_functions.updateLog(previous_document, process_id, operation, update_field, current_value, new_value_list)
-                            result = collection.update_one(update_criteria, {"$set": {update_field: new_value_list, "log": updated_log}})
-                            if result.modified_count > 0:
-                                updates_made += 1
-                        else:
-                            print(f"Field '{update_field}' already exists and has the same value in document with stable_id: {value_to_match}. No update required.")
-                    else:
-                        print(f"The document with '{field_to_match}': {value_to_match} is not in the collection.")
-                
-                # Log the results of updates
-                if updates_made > 0:
-                    print(f"Total number of updates made: {updates_made}.")
-                else:
-                    log_functions.deleteLog(db, str(process_id))
-                    print(f"No changes were made.")
-                    
-            else:
-                print(f"{f} is not a CSV file.")
-        print("Updates finished!")
+            total_updates += updateCsvFile(operation, db, collection_name, f, name, method, batch_size, log_backend, snapshot_interval, in_flight, parameters, resume if resume and f == resume_file else None)
+        if len(csv_files) > 1:
+            report.message(f"Total number of updates made across files: {total_updates}.")
+        report.message("Updates finished!")
     else:
-        print(f"{update_file} file or directory does not exist.")
\ No newline at end of file
+        report.warning(f"{update_file} file or directory does not exist.")
\ No newline at end of file
@@ -10,9 +10,8 @@ __status__ = "development"
 
 # Import packages
 import sys
-from pymongo import MongoClient
 import conf
-from source import insert, update_value, restore_value, rename_field, new_field, remove_field, mongoConnection
+from source import insert, update_value, restore_value, rename_field, new_field, remove_field, index_functions, connection, log_storage, resume, history, metrics, report
 
 # Functions
 def print_help():
@@ -23,10 +22,8 @@ def print_help():
 
 def connect_mongo():
     try:
-        # Connect to MongoDB
-        client = MongoClient(mongoConnection.mongo_host, mongoConnection.mongo_port, username=mongoConnection.username, password=mongoConnection.password, authSource=mongoConnection.auth_source)
-        # Acces the database:
-        db = client[conf.database_name]
+        # Connect to MongoDB and access the database:
+        db = connection.connectDatabase(conf.database_name)
         # If connection successful, print success message
         print("Connection to BioMongoDB established.")
 
@@ -42,50 +39,92 @@ def run_operation():
     # Get database connection:
     db = connect_mongo()
 
+    # Export the metrics of the processes besides saving them in log_details
+    metrics.export_format = conf.metrics_export
+    metrics.export_file = conf.metrics_file
+    metrics.measure_replies = conf.metrics_export != ''
+
+    # Report the progress at the chosen verbosity, and the line of every document in the report file
+    report.verbosity = conf.verbosity
+    report.progress_interval = conf.progress_interval
+    if conf.report_file != '':
+        report.openDetails(conf.report_file)
+    try:
+        run_selected_operation(db)
+    finally:
+        report.closeDetails()
+
+def run_selected_operation(db):
+    """
+    Run the operation selected in the conf file
+    """
+
     if conf.operation == 'insert' and conf.json_documents != '':
-        insert.insertDocuments(conf.operation, db, conf.collection_name, conf.json_documents, conf.name, conf.method)
+        insert.insertDocuments(conf.operation, db, conf.collection_name, conf.json_documents, conf.name, conf.method, conf.workers, conf.log_backend, conf.insert_mode)
     
     elif conf.operation == 'update_one' and conf.update_field != '' and conf.new_value != '':
-        update_value.updateOne(conf.operation, db, conf.collection_name, conf.update_criteria, conf.update_field, conf.new_value, conf.name, conf.method)
+        update_value.updateOne(conf.operation, db, conf.collection_name, conf.update_criteria, conf.update_field, conf.new_value, conf.name, conf.method, conf.log_backend, conf.snapshot_interval)
 
     elif conf.operation == 'update_all' and conf.update_field != '' and conf.new_value != '':
-        update_value.updateAll(conf.operation, db, conf.collection_name, conf.update_field, conf.new_value, conf.name, conf.method)
+        update_value.updateAll(conf.operation, db, conf.collection_name, conf.update_field, conf.new_value, conf.name, conf.method, conf.engine, conf.log_backend, conf.batch_size, conf.snapshot_interval, conf.in_flight)
 
     elif conf.operation == 'update_with_file' and conf.update_file != '':
-        update_value.updateFile(conf.operation, db, conf.collection_name, conf.update_file, conf.name, conf.method)
+        update_value.updateFile(conf.operation, db, conf.collection_name, conf.update_file, conf.name, conf.method, conf.batch_size, conf.log_backend, conf.snapshot_interval, conf.in_flight, conf.workers, conf.validation)
 
     elif conf.operation == 'restore_one' and conf.restore_criteria != '' and conf.log_id != '':
-        restore_value.restoreOne(conf.operation, db, conf.collection_name, conf.restore_criteria, conf.log_id, conf.name, conf.method)
+        restore_value.restoreOne(conf.operation, db, conf.collection_name, conf.restore_criteria, conf.log_id, conf.name, conf.method, conf.log_backend, conf.snapshot_interval)
 
     elif conf.operation == 'restore_all' and conf.log_id != '':
-        restore_value.restoreAll(conf.operation, db, conf.collection_name, conf.log_id, conf.name, conf.method)
+        restore_value.restoreAll(conf.operation, db, conf.collection_name, conf.log_id, conf.name, conf.method, conf.batch_size, conf.log_backend, conf.snapshot_interval, conf.in_flight)
 
     elif conf.operation == 'add_empty_field' and conf.new_field != '':
-        new_field.addNullField(conf.operation, db, conf.collection_name, conf.new_field, conf.name, conf.method)
+        new_field.addNullField(conf.operation, db, conf.collection_name, conf.new_field, conf.name, conf.method, conf.log_backend)
 
     elif conf.operation == 'rename_field' and conf.field_name != '' and conf.new_field_name != '':
-        rename_field.renameField(conf.operation, db, conf.collection_name, conf.field_name, conf.new_field_name, conf.name, conf.method)
+        rename_field.renameField(conf.operation, db, conf.collection_name, conf.field_name, conf.new_field_name, conf.name, conf.method, conf.log_backend)
 
     elif conf.operation == 'remove_field' and conf.field_to_remove != '':
-        remove_field.removeField(conf.operation, db, conf.collection_name, conf.field_to_remove, conf.name, conf.method)
+        remove_field.removeField(conf.operation, db, conf.collection_name, conf.field_to_remove, conf.name, conf.method, conf.log_backend)
+
+    elif conf.operation == 'ensure_indexes':
+        index_functions.ensureIndexes(db, conf.collection_name, conf.log_backend)
+
+    elif conf.operation == 'resume':
+        resume.resumeProcess(db, conf.collection_name, conf.resume_log_id, conf.name, conf.in_flight)
+
+    elif conf.operation == 'history' and (conf.history_log_id != '' or conf.history_date != ''):
+        history.exportHistory(db, conf.collection_name, conf.history_file, conf.history_criteria, conf.history_log_id, conf.history_date, conf.history_fields, conf.log_backend)
 
     else:
         print('Something is missing in the conf.py file')
 
+# Operations that don't create a process in log_details, they don't need the name and method
+read_only_operations = ['ensure_indexes', 'history']
+
 def main():
     if conf.operation == '' and conf.database_name == '' and conf.collection_name == '' and conf.name == '' and conf.method == '':
         # First print help message just in case.
         print_help()
-    elif conf.operation == '' or conf.operation not in ['insert', 'update_one', 'update_all', 'update_with_file', 'restore_one', 'restore_all', 'add_empty_field', 'rename_field', 'remove_field']:
+    elif conf.operation == '' or conf.operation not in ['insert', 'update_one', 'update_all', 'update_with_file', 'restore_one', 'restore_all', 'add_empty_field', 'rename_field', 'remove_field', 'ensure_indexes', 'resume', 'history']:
         print("Operation is missing or wrong.")
     elif conf.database_name == '':
         print("Database is missing.")
     elif conf.collection_name == '':
         print("Collection name is missing.")
-    elif conf.name == '':
+    elif conf.name == '' and conf.operation not in read_only_operations:
         print("Your name is missing.")
-    elif conf.method == '':
+    elif conf.method == '' and conf.operation not in read_only_operations:
         print("The method you used to obtain the information is missing.")
+    elif conf.log_backend not in log_storage.log_backends:
+        print(f"Log backend is wrong, it should be one of: {', '.join(log_storage.log_backends)}.")
+    elif conf.metrics_export not in metrics.export_formats:
+        print(f"Metrics export is wrong, it should be one of: {', '.join(repr(export_format) for export_format in metrics.export_formats)}.")
+    elif conf.metrics_export != '' and conf.metrics_file == '':
+        print("The file to export the metrics to is missing.")
+    elif conf.verbosity not in [report.quiet, report.normal, report.detailed]:
+        print("Verbosity is wrong, it should be 0, 1 or 2.")
+    elif conf.validation not in update_value.validation_modes:
+        print(f"Validation is wrong, it should be one of: {', '.join(repr(validation) for validation in update_value.validation_modes)}.")
     else:
         print(f'Operation: {conf.operation}')
         print(f'Database: {conf.database_name}')
@@ -93,7 +132,7 @@ def main():
         # Run the operation determined in conf:
         run_operation()
 
-if __name__ == main():
+if __name__ == "__main__":
     main()
 
 